@@ -83,5 +83,5 @@ if not app.debug:
     app.logger.info('Microblog startup')
 
 #import down here to avoid circular import
-from app import routes, models, errors
+from app import routes, models, errors, fragments, profiling, api, language, responses
 
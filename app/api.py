@@ -0,0 +1,141 @@
+from datetime import datetime
+from functools import wraps
+from hashlib import md5
+from flask import request, jsonify, url_for, make_response
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+from app import app, db
+from app.models import User, Post, followers, timeline
+from app.pagination import paginate_cursor
+from app.database import replica
+from app.export import MIMETYPES, read_field
+
+#JSON versions of the feeds for clients that poll
+#Each response carries an ETag and Last-Modified taken from the newest post in the
+#feed, found with a one row index lookup, and from User.last_changed of the users
+#the feed depends on (the reader and who they follow for the timeline, the author
+#for a user's posts), so follows, unfollows and profile edits count as changes too.
+#A poll with If-None-Match/If-Modified-Since that still matches gets a 304 before
+#the feed query runs
+#?since=<ISO timestamp> only returns posts newer than that, ?cursor= pages back
+#through older posts like the HTML views, ?limit= sets the page size (max 100)
+
+#Flask-Login's login_required would redirect to the login page
+def api_login_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'authentication required'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+def serialize_post(post):
+    return {'id': post.id, 'body': post.body, 'timestamp': post.timestamp.isoformat() + 'Z',
+            'language': post.language or None, 'author': post.author.username}
+
+#(timestamp, id) of the newest row of a select ordered like the feed, or None
+def newest(query, ts_col, id_col):
+    return db.session.execute(query.order_by(ts_col.desc(), id_col.desc()).limit(1)).first()
+
+def parse_since():
+    since = request.args.get('since')
+    if not since:
+        return None
+    try:
+        return datetime.fromisoformat(since.rstrip('Z'))
+    except ValueError:
+        return None
+
+#The ETag covers the newest post and last change, the query string and who is asking
+#(timelines differ per user)
+def feed_etag(head):
+    return md5('{}|{}|{}'.format(request.full_path, current_user.id, head and tuple(head)).encode('utf-8')).hexdigest()
+
+def validators(response, etag, timestamp):
+    response.set_etag(etag)
+    if timestamp is not None:
+        response.last_modified = timestamp
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+#Head query gives the newest (timestamp, id) cheaply, feed is only called when the
+#client needs the page, keys are the (timestamp, id) columns the feed is ordered by
+#changed is a select of the latest last_changed the feed depends on, it runs as
+#part of the head query
+def feed_response(head_query, feed, keys, endpoint, changed=None, **kwargs):
+    if changed is not None:
+        head_query = head_query.add_columns(changed.scalar_subquery())
+    head = newest(head_query, *keys)
+    etag, timestamp = feed_etag(head), head[0] if head else None
+    if changed is not None and head and head[2] is not None:
+        timestamp = max(timestamp, head[2])
+    if not is_resource_modified(request.environ, etag=etag, last_modified=timestamp):
+        return validators(make_response('', 304), etag, timestamp)
+    query = feed()
+    since = parse_since()
+    if since is not None:
+        query = query.filter(keys[0] > since)
+    per_page = min(request.args.get('limit', app.config['POSTS_PER_PAGE'], type=int), 100)
+    page = paginate_cursor(query, request.args.get('cursor'), max(per_page, 1), keys)
+    args = {key: request.args[key] for key in ('since', 'limit') if key in request.args}
+    next_url = url_for(endpoint, cursor=page.next_cursor, **args, **kwargs) if page.has_next else None
+    return validators(jsonify({
+        'posts': [serialize_post(post) for post in page.items],
+        'next': next_url,
+        'newest': head[0].isoformat() + 'Z' if head else None}), etag, timestamp)
+
+@app.route('/api/timeline')
+@api_login_required
+def api_timeline():
+    user = current_user
+    keys = User.followed_posts_keys()
+    if app.config['TIMELINE_FANOUT']:
+        head = db.select(*keys).where(timeline.c.user_id == user.id)
+    else:
+        head = db.select(*keys).where(db.or_(Post.user_id == user.id, Post.user_id.in_(
+            db.select(followers.c.followed_id).where(followers.c.follower_id == user.id))))
+    changed = db.select(db.func.max(User.last_changed)).where(db.or_(User.id == user.id, User.id.in_(
+        db.select(followers.c.followed_id).where(followers.c.follower_id == user.id))))
+    return feed_response(head, user.followed_posts, keys, 'api_timeline', changed)
+
+@app.route('/api/explore')
+@api_login_required
+def api_explore():
+    keys = (Post.timestamp, Post.id)
+    return feed_response(db.select(*keys), lambda: replica(Post.query.options(db.selectinload(Post.author))),
+                         keys, 'api_explore')
+
+@app.route('/api/users/<username>/posts')
+@api_login_required
+def api_user_posts(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return jsonify({'error': 'not found'}), 404
+    keys = (Post.timestamp, Post.id)
+    return feed_response(db.select(*keys).where(Post.user_id == user.id), lambda: replica(user.posts),
+                         keys, 'api_user_posts', db.select(User.last_changed).where(User.id == user.id),
+                         username=user.username)
+
+#Follows a list of users in one go, for moving a graph over from somewhere else
+#Takes {"usernames": [...]} or a followers/following export (CSV or JSONL, sent
+#with its content type), at most FOLLOW_IMPORT_LIMIT names per request
+@app.route('/api/follow', methods=['POST'])
+@api_login_required
+def api_follow():
+    formats = {mimetype: format for format, mimetype in MIMETYPES.items()}
+    try:
+        if request.is_json:
+            usernames = (request.get_json(silent=True) or {}).get('usernames')
+        elif request.mimetype in formats:
+            usernames = read_field(request.get_data(as_text=True), 'username', formats[request.mimetype])
+        else:
+            return jsonify({'error': 'send JSON, CSV or JSONL'}), 415
+    except (ValueError, AttributeError, KeyError):
+        usernames = None
+    if not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames):
+        return jsonify({'error': 'expected a list of usernames'}), 400
+    if len(usernames) > app.config['FOLLOW_IMPORT_LIMIT']:
+        return jsonify({'error': 'at most {} usernames per request'.format(app.config['FOLLOW_IMPORT_LIMIT'])}), 413
+    followed = current_user.follow_many(usernames)
+    db.session.commit()
+    return jsonify({'followed': len(followed), 'skipped': len(set(usernames)) - len(followed)})
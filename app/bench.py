@@ -0,0 +1,155 @@
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from app import app, db
+from app.models import User, Post, followers, timeline
+from app.search import get_index
+
+#Synthetic data and load generation for "flask bench seed" / "flask bench run"
+
+WORDS = ('the a an and or but to of in on for with at from by about like just really very '
+         'today tomorrow yesterday morning night week weekend coffee tea lunch dinner code '
+         'python flask database query index cache server bug fix release test deploy music '
+         'movie book game walk run city park rain sun snow friend family work home happy '
+         'tired great new old first last best worst idea thought question answer').split()
+
+#Default endpoints for run(), {username} and {word} are filled in per request
+ENDPOINTS = ['/index', '/explore', '/user/{username}', '/search?q={word}']
+
+def sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(3, 20))
+    return ' '.join(words)[:140]
+
+#Zipf weights over ids in a random order, so a few accounts end up with most of the
+#followers (or write most of the posts) whatever order they were created in
+def popularity(ids, exponent, rng):
+    ranked = list(ids)
+    rng.shuffle(ranked)
+    weights, total = [], 0
+    for rank in range(len(ranked)):
+        total += 1 / (rank + 1) ** exponent
+        weights.append(total)
+    return ranked, weights
+
+#Adds users new accounts, each following about follows others picked by popularity,
+#and posts posts spread over the last days days. Everything goes in with Core
+#executemany inserts batch rows at a time, then counters, timelines and the search
+#index (which only see ORM writes) are brought up to date in bulk
+def seed(users, posts, follows=20, exponent=1.1, days=30, batch=5000, seed=None, password='bench'):
+    rng = random.Random(seed)
+    last = db.session.scalar(db.select(db.func.max(User.id))) or 0
+    password_hash = generate_password_hash(password)
+    now = datetime.utcnow()
+
+    rows = []
+    for i in range(last + 1, last + users + 1):
+        email = 'bench{}@example.com'.format(i)
+        rows.append({'username': 'bench{}'.format(i), 'email': email, 'email_hash': User.hash_email(email),
+                     'password_hash': password_hash, 'about_me': sentence(rng), 'last_seen': now})
+    insert(User.__table__, rows, batch)
+    ids = db.session.scalars(db.select(User.id).where(User.id > last).order_by(User.id)).all()
+    if not ids:
+        return {'users': 0, 'follows': 0, 'posts': 0}
+    ranked, weights = popularity(ids, exponent, rng)
+
+    #Out-degree is Pareto distributed too (mean follows), most users follow a
+    #handful of accounts and a few follow thousands
+    edges = []
+    for id in ids:
+        degree = min(len(ids) - 1, int(follows / 2 * rng.paretovariate(2)))
+        targets = set(rng.choices(ranked, cum_weights=weights, k=degree)) if degree else set()
+        targets.discard(id)
+        edges.extend({'follower_id': id, 'followed_id': target} for target in targets)
+    insert(followers, edges, batch)
+
+    #How much someone posts is skewed the same way but independent of how many
+    #followers they have
+    start = now - timedelta(days=days)
+    writers, activity = popularity(ids, exponent, rng)
+    authors = rng.choices(writers, cum_weights=activity, k=posts)
+    post_rows = [{'body': sentence(rng), 'user_id': author, 'language': 'en',
+                  'timestamp': start + timedelta(seconds=rng.uniform(0, days * 86400))}
+                 for author in authors]
+    insert(Post.__table__, post_rows, batch)
+
+    User.repair_counts()
+    if app.config['TIMELINE_FANOUT']:
+        followed = db.select(followers.c.follower_id, Post.timestamp, Post.id).join(
+            Post, Post.user_id == followers.c.followed_id).where(followers.c.follower_id > last)
+        own = db.select(Post.user_id, Post.timestamp, Post.id).where(Post.user_id > last)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'timestamp', 'post_id'], followed.union_all(own)))
+    db.session.commit()
+    get_index().rebuild()
+    return {'users': len(ids), 'follows': len(edges), 'posts': len(post_rows)}
+
+def insert(table, rows, batch):
+    for i in range(0, len(rows), batch):
+        db.session.execute(table.insert(), rows[i:i + batch])
+
+#Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+#Drives the routes with clients threads, each its own test client logged in as a
+#random seeded user, for duration seconds (or requests requests per client).
+#Returns {endpoint: {'requests', 'errors', 'rps', 'p50', 'p95', 'p99'}} with
+#latencies in milliseconds, plus the totals under 'all'
+def run(duration=10, clients=4, endpoints=None, requests=None, seed=None):
+    endpoints = endpoints or ENDPOINTS
+    rng = random.Random(seed)
+    usernames = db.session.scalars(db.select(User.username).order_by(User.id)).all()
+    ids = dict(db.session.execute(db.select(User.username, User.id)).all())
+    if not usernames:
+        raise ValueError('No users, run "flask bench seed" first')
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(client_rng):
+        client = app.test_client()
+        username = client_rng.choice(usernames)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(ids[username])
+        results, done = [], 0
+        while time.monotonic() < deadline and (requests is None or done < requests):
+            endpoint = endpoints[done % len(endpoints)]
+            url = endpoint.format(username=client_rng.choice(usernames), word=client_rng.choice(WORDS))
+            started = time.perf_counter()
+            try:
+                response = client.get(url)
+                response.close()
+                status = response.status_code
+            except Exception:
+                app.logger.exception('Benchmark request to %s failed', url)
+                status = 500
+            results.append((endpoint, time.perf_counter() - started, status))
+            done += 1
+        with lock:
+            samples.extend(results)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(random.Random(rng.random()),)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    report = {}
+    for endpoint in endpoints + ['all']:
+        rows = [sample for sample in samples if endpoint in ('all', sample[0])]
+        latencies = sorted(latency * 1000 for name, latency, status in rows)
+        report[endpoint] = {
+            'requests': len(rows),
+            'errors': sum(1 for name, latency, status in rows if status >= 400),
+            'rps': len(rows) / elapsed if elapsed else 0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)}
+    return report
@@ -0,0 +1,217 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+#Small key/value caches with LRU eviction under a memory cap,
+#used for rendered fragments and other things that are expensive to rebuild
+#Both backends have the same get/set/delete/clear interface, values can be
+#anything picklable, ttl is in seconds (None keeps the value until evicted)
+
+#Rough size of a value, exact for text and bytes
+def value_size(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return len(pickle.dumps(value))
+
+#In-process cache, shared by the threads of one worker
+class MemoryCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            value, size, expires = item
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        size = value_size(value)
+        if size > self.max_bytes:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self._remove(key)
+            self.items[key] = (value, size, expires)
+            self.size += size
+            #Least recently used entries go first
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.items)))
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+#Cache in a local SQLite file, survives restarts and is shared by every worker
+#process on the box. Each thread gets its own connection
+#Summing sizes is a table scan, so the cap is only checked every EVICT_EVERY writes
+#and eviction then goes down to 90% of it
+class SQLiteCache(object):
+    EVICT_EVERY = 64
+    #A hit only writes its atime when the stored one is older than this many seconds,
+    #hot keys are read over and over and LRU order doesn't need to be finer than that
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.writes = 0
+        self.local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, '
+            'size INTEGER, expires REAL, atime REAL)')
+        self.connection().execute('CREATE INDEX IF NOT EXISTS ix_cache_atime ON cache (atime)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        conn = self.connection()
+        row = conn.execute('SELECT value, expires, atime FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        now = time.time()
+        if row[1] is not None and row[1] < now:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return default
+        if now - row[2] >= self.TOUCH_INTERVAL:
+            conn.execute('UPDATE cache SET atime = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value)
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, size, expires, atime) VALUES (?, ?, ?, ?, ?)',
+                     (key, data, len(data), expires, now))
+        self.writes += 1
+        if self.writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self.connection().execute('DELETE FROM cache')
+
+    #Drops expired rows, then least recently used ones until under 90% of the cap
+    def evict(self):
+        conn = self.connection()
+        total = conn.execute('SELECT coalesce(sum(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        conn.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        rows = conn.execute('SELECT key, size FROM cache ORDER BY atime DESC').fetchall()
+        kept, drop = 0, []
+        for key, size in rows:
+            kept += size
+            if kept > self.max_bytes * 0.9:
+                drop.append((key,))
+        conn.executemany('DELETE FROM cache WHERE key = ?', drop)
+
+#backend is 'memory' or 'sqlite', anything else means no cache (returns None)
+def make_cache(backend, max_bytes, path=None):
+    if backend == 'memory':
+        return MemoryCache(max_bytes)
+    if backend == 'sqlite':
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        return SQLiteCache(path, max_bytes)
+    return None
+
+#Short lived cache of a model's rows by primary key, for lookups that happen on
+#every request (Flask-Login's user_loader). Rows are stored as plain dicts of column
+#values (minus exclude, which stay unloaded and are fetched if touched) and turned
+#back into an instance attached to the session without a query
+#Rows written through the session are dropped when flushed and again on commit, so a
+#request racing the commit can't put the old row back. Core updates have to call expire()
+class RowCache(object):
+    def __init__(self, model, cache, ttl=30, exclude=()):
+        self.model = model
+        self.cache = cache
+        self.ttl = ttl
+        self.columns = [attr.key for attr in inspect(model).column_attrs if attr.key not in exclude]
+
+    def key(self, id):
+        return '{}:{}'.format(self.model.__tablename__, id)
+
+    def get(self, session, id):
+        row = self.cache.get(self.key(id)) if self.cache is not None else None
+        if row is None:
+            obj = session.get(self.model, id)
+            if obj is not None:
+                self.set(obj)
+            return obj
+        obj = inspect(self.model).class_manager.new_instance()
+        for key, value in row.items():
+            set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        return session.merge(obj, load=False)
+
+    #Only caches instances with every column loaded and nothing pending
+    def set(self, obj):
+        if self.cache is None:
+            return
+        state = inspect(obj)
+        if state.modified or any(key not in state.dict for key in self.columns):
+            return
+        self.cache.set(self.key(state.identity[0]), {key: state.dict[key] for key in self.columns}, self.ttl)
+
+    def delete(self, id):
+        if self.cache is not None:
+            self.cache.delete(self.key(id))
+
+    #Drops the row now and once more when session commits
+    def expire(self, session, id):
+        self.delete(id)
+        session.info.setdefault('expired_rows', set()).add((self, id))
+
+    def listen(self, session):
+        @event.listens_for(session, 'after_flush')
+        def expire_flushed(session, flush_context):
+            for obj in list(session.dirty) + list(session.deleted):
+                if isinstance(obj, self.model) and inspect(obj).identity is not None:
+                    self.expire(session, inspect(obj).identity[0])
+
+        @event.listens_for(session, 'after_commit')
+        def expire_committed(session):
+            for cache, id in session.info.pop('expired_rows', ()):
+                cache.delete(id)
+
+        @event.listens_for(session, 'after_soft_rollback')
+        def forget_expired(session, previous_transaction):
+            session.info.pop('expired_rows', None)
@@ -1,6 +1,13 @@
 import os
+import time
 import click
-from app import app
+from app import app, db
+from app.models import User, Post
+from app.jobs import job_queue
+from app.language import language_detector
+from app.search import get_index
+from app import bench as app_bench
+from app import export as app_export
 
 # Adds command line commands to make adding, updating, and compiling 
 # languages easier
@@ -37,4 +44,187 @@ def update():
 def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
-        raise RuntimeError('compile command failed')
\ No newline at end of file
+        raise RuntimeError('compile command failed')
+
+
+@app.cli.group()
+def timeline():
+    """Precomputed home timeline commands."""
+    pass
+
+
+@timeline.command(name='rebuild')
+def timeline_rebuild():
+    """Rebuild every user's timeline from followers and posts."""
+    for user in User.query.all():
+        user.rebuild_timeline()
+    db.session.commit()
+
+
+@timeline.command()
+def check():
+    """Compare stored timelines against the computed feed query."""
+    drifted = 0
+    for user in User.query.all():
+        missing, extra = user.timeline_drift()
+        if missing or extra:
+            drifted += 1
+            click.echo('{}: {} missing, {} extra'.format(
+                user.username, len(missing), len(extra)))
+    click.echo('{} timeline(s) out of sync'.format(drifted))
+
+
+@app.cli.group()
+def counters():
+    """Denormalized follower/following/post counter commands."""
+    pass
+
+
+@counters.command()
+def repair():
+    """Recompute all user counters and fix any that drifted."""
+    repaired = User.repair_counts()
+    db.session.commit()
+    click.echo('{} user(s) repaired'.format(repaired))
+
+
+@app.cli.command()
+@click.option('--workers', type=int, help='Jobs run at once, defaults to JOB_WORKERS.')
+@click.option('--pool', type=click.Choice(['thread', 'process']), help='Defaults to JOB_POOL.')
+def worker(workers, pool):
+    """Run queued jobs until interrupted."""
+    job_queue.workers = workers or job_queue.workers
+    job_queue.pool = pool or job_queue.pool
+    click.echo('Running jobs with {} {}(s) from {}'.format(job_queue.workers, job_queue.pool, job_queue.path))
+    job_queue.serve()
+
+
+@app.cli.group()
+def jobs():
+    """Background job queue commands."""
+    pass
+
+
+@jobs.command(name='run')
+def jobs_run():
+    """Run every queued job that is due now."""
+    click.echo('{} job(s) processed'.format(job_queue.drain()))
+
+
+@jobs.command()
+def stats():
+    """Show queue depth and run times per task."""
+    for name, status, count in job_queue.depth():
+        click.echo('{} {}: {}'.format(name, status, count))
+    for name, runs, failures, average, longest, wait in job_queue.stats():
+        click.echo('{}: {} run(s), {} failed, {:.1f} ms average, {:.1f} ms max, {:.1f} ms average wait'.format(
+            name, runs, failures, average * 1000, longest * 1000, wait * 1000))
+
+
+@jobs.command()
+def dead():
+    """List jobs that ran out of attempts."""
+    for id, name, args, attempts, error in job_queue.dead_letters():
+        click.echo('{} {}{} after {} attempt(s): {}'.format(id, name, args, attempts, error))
+
+
+@jobs.command()
+def retry():
+    """Put dead jobs back in the queue."""
+    click.echo('{} job(s) requeued'.format(job_queue.retry_dead()))
+
+
+@app.cli.group()
+def export():
+    """Data export commands."""
+    pass
+
+
+@export.command()
+@click.argument('username')
+@click.option('--format', 'format', type=click.Choice(['jsonl', 'csv']), default='jsonl')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output.')
+@click.option('--output', type=click.File('wb'), default='-', help='File to write, stdout by default.')
+def posts(username, format, compress, output):
+    """Stream a user's posts as JSONL or CSV."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException('No user {}'.format(username))
+    chunks = app_export.encode(app_export.post_rows(db.session, user.id), app_export.POST_FIELDS, format)
+    if compress:
+        chunks = app_export.gzip_chunks(chunks)
+    for chunk in chunks:
+        output.write(chunk if compress else chunk.encode('utf-8'))
+
+
+@app.cli.group()
+def language():
+    """Post language detection commands."""
+    pass
+
+
+@language.command()
+@click.option('--all', 'redetect', is_flag=True, help='Redetect posts that already have a language.')
+@click.option('--batch', default=500, help='Posts per batch.')
+def backfill(redetect, batch):
+    """Detect the language of existing posts in bulk."""
+    query = db.select(Post.id, Post.body).order_by(Post.id).limit(batch)
+    if not redetect:
+        query = query.where(Post.language.is_(None))
+    last, done = 0, 0
+    while True:
+        rows = db.session.execute(query.where(Post.id > last)).all()
+        if not rows:
+            break
+        language_detector.process([(id, body or '') for id, body in rows])
+        last = rows[-1][0]
+        done += len(rows)
+    click.echo('{} post(s) processed'.format(done))
+
+
+@app.cli.group()
+def search():
+    """Full-text search index commands."""
+    pass
+
+
+@search.command(name='rebuild')
+def search_rebuild():
+    """Rebuild the search index from every post and user."""
+    get_index().rebuild()
+    click.echo('Search index rebuilt')
+
+
+@app.cli.group()
+def bench():
+    """Benchmark data and load generation commands."""
+    pass
+
+
+@bench.command()
+@click.option('--users', default=1000, help='Users to create.')
+@click.option('--posts', default=10000, help='Posts to create.')
+@click.option('--follows', default=20, help='Average accounts followed per user.')
+@click.option('--days', default=30, help='Spread post timestamps over this many days.')
+@click.option('--seed', 'random_seed', type=int, help='Random seed for a repeatable data set.')
+def seed(users, posts, follows, days, random_seed):
+    """Bulk insert users, a power-law follow graph and posts."""
+    started = time.monotonic()
+    counts = app_bench.seed(users, posts, follows, days=days, seed=random_seed)
+    click.echo('{users} user(s), {follows} follow(s), {posts} post(s)'.format(**counts) +
+               ' in {:.1f}s'.format(time.monotonic() - started))
+
+
+@bench.command(name='run')
+@click.option('--duration', default=10.0, help='Seconds to run for.')
+@click.option('--clients', default=4, help='Concurrent clients.')
+@click.option('--endpoint', 'endpoints', multiple=True,
+              help='URL to request, {username} and {word} are filled in. Repeatable.')
+def bench_run(duration, clients, endpoints):
+    """Drive the routes concurrently and report throughput and latency."""
+    report = app_bench.run(duration, clients, list(endpoints) or None)
+    click.echo('{:<24} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, stats in report.items():
+        click.echo('{:<24} {requests:>8} {errors:>6} {rps:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}'.format(
+            endpoint, **stats))
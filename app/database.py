@@ -0,0 +1,49 @@
+from sqlalchemy import event
+from app import app, db
+
+#Connection level tuning and read routing for the SQLAlchemy engines
+#Pool settings come in through SQLALCHEMY_ENGINE_OPTIONS (see config.py)
+
+#SQLite pragmas run on every new connection: WAL lets readers carry on while
+#someone writes, synchronous=NORMAL only syncs at checkpoints (safe with WAL),
+#mmap serves reads from the page cache and busy_timeout makes a writer wait for
+#the lock instead of failing with "database is locked"
+def sqlite_pragmas(config):
+    return [('journal_mode', config['SQLITE_JOURNAL_MODE']),
+            ('synchronous', config['SQLITE_SYNCHRONOUS']),
+            ('mmap_size', config['SQLITE_MMAP_SIZE']),
+            ('busy_timeout', config['SQLITE_BUSY_TIMEOUT'])]
+
+def tune_sqlite(engine, pragmas):
+    if engine.dialect.name != 'sqlite':
+        return
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+#ORM queries marked with replica() go to the 'read' bind (DATABASE_READ_URL) when
+#there is one: a read replica, or on SQLite the same file opened read only, so
+#feed reads run on their own connections instead of queueing behind writes.
+#Without it they run on the primary as usual. A replica may lag behind the
+#primary, only pages that can live with that should use it
+def replica(query):
+    return query.execution_options(replica=True)
+
+@event.listens_for(db.session, 'do_orm_execute')
+def route_to_replica(orm_execute_state):
+    if not orm_execute_state.is_select or not orm_execute_state.execution_options.get('replica'):
+        return
+    engine = db.engines.get('read')
+    if engine is not None:
+        orm_execute_state.bind_arguments['bind'] = engine
+
+#A read only connection can't switch the journal mode, it follows the primary's
+with app.app_context():
+    for key, engine in db.engines.items():
+        pragmas = sqlite_pragmas(app.config)
+        if key == 'read':
+            pragmas = [pragma for pragma in pragmas if pragma[0] != 'journal_mode']
+        tune_sqlite(engine, pragmas)
@@ -1,18 +1,30 @@
-from flask_mail import Message
 from app import app, mail
+from app.jobs import BatchError, job_queue, task
 from flask import render_template
-from threading import Thread
+from flask_mail import Message
 from flask_babel import _
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-        
+#Queues the message and returns right away, a job worker sends it
+#(and retries it with backoff if the mail server can't be reached)
 def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender, recipients)
-    msg.body = text_body
-    msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    job_queue.enqueue('send_email', str(subject), sender, recipients, text_body, html_body)
+
+#Sends up to MAIL_BATCH_SIZE queued messages over one SMTP connection. When the
+#server can't be reached the whole batch is tried again later, messages it
+#refuses are retried on their own and the rest aren't sent twice
+@task('send_email', priority=10, batch=app.config['MAIL_BATCH_SIZE'])
+def deliver_emails(messages):
+    failed = []
+    error = None
+    with mail.connect() as conn:
+        for i, (subject, sender, recipients, text_body, html_body) in enumerate(messages):
+            try:
+                conn.send(Message(subject, sender=sender, recipients=recipients, body=text_body, html=html_body))
+            except Exception as e:
+                failed.append(i)
+                error = e
+    if failed:
+        raise BatchError(failed, error)
 
 
 def send_password_reset_email(user):
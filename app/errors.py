@@ -1,5 +1,6 @@
 from flask import render_template
 from app import app, db
+from app.passwords import HashingBusy
 
 #Second value is error code number
 @app.errorhandler(404)
@@ -10,4 +11,9 @@ def not_found_error(error):
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
-    
\ No newline at end of file
+    
+#Every password hashing thread is busy and the queue is full (see app/passwords.py)
+@app.errorhandler(HashingBusy)
+def hashing_busy_error(error):
+    db.session.rollback()
+    return render_template('500.html'), 503
@@ -0,0 +1,138 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from flask import g
+from app import app, db
+from app.models import Post
+from app.fragments import render_post
+from app.pagination import CursorPage, decode_cursor, encode_cursor
+from app.database import replica
+
+#The newest posts as of one refresh: their (timestamp, id) keys newest first and
+#the rendered _post.html rows for each locale in the same order. Never changed
+#after it is built, a refresh swaps in a new one, so requests can read it without locks
+#complete is True when the snapshot holds every post there is
+class ExploreSnapshot(object):
+    def __init__(self, keys, rows, complete, built):
+        self.keys = keys
+        self.ascending = keys[::-1]
+        self.rows = rows
+        self.complete = complete
+        self.built = built
+
+    #(start, end, has_older) for the rows from start, None when the page runs
+    #past the end of the snapshot and the rest has to come from the database
+    def span(self, start, per_page):
+        end = start + per_page
+        if end > len(self.keys) and not self.complete:
+            return None
+        end = min(end, len(self.keys))
+        return start, end, end < len(self.keys) or not self.complete
+
+    #Same as paginate_cursor over the explore query, the cursor's row is found with bisect
+    def cursor_page(self, locale, cursor, per_page):
+        rows = self.rows.get(locale)
+        decoded = decode_cursor(cursor) if cursor else None
+        if rows is None:
+            return None
+        if decoded is None:
+            start = 0
+        elif decoded[0] == 'n':
+            start = len(self.keys) - bisect_left(self.ascending, decoded[1:])
+        else:
+            start = max(0, len(self.keys) - bisect_right(self.ascending, decoded[1:]) - per_page)
+        span = self.span(start, per_page)
+        if span is None:
+            return None
+        start, end, has_older = span
+        if start == end:
+            return CursorPage([])
+        next_cursor = encode_cursor('n', *self.keys[end - 1]) if has_older else None
+        prev_cursor = encode_cursor('p', *self.keys[start]) if start > 0 else None
+        return CursorPage(rows[start:end], next_cursor, prev_cursor)
+
+    #(rows, has_next) for ?page=N links, None past the snapshot
+    def offset_page(self, locale, page, per_page):
+        rows = self.rows.get(locale)
+        if rows is None or page < 1:
+            return None
+        span = self.span((page - 1) * per_page, per_page)
+        if span is None:
+            return None
+        start, end, has_older = span
+        return rows[start:end], has_older
+
+#Shared snapshot of the first EXPLORE_CACHE_PAGES pages of /explore
+#A background thread rebuilds it every EXPLORE_CACHE_INTERVAL seconds and as soon
+#as invalidate() is called (new posts, profile edits, detected languages), while
+#requests keep being served from the previous snapshot (stale-while-revalidate),
+#so no request ever waits on a refresh. Refreshes start at least min_interval
+#seconds apart, so a burst of posts costs one refresh instead of one each. Until
+#the first refresh finishes, and for pages past the snapshot, explore reads the
+#database as before
+#An interval of 0 turns the thread off: snapshots only come from refresh() and
+#invalidate() drops the current one
+class ExploreCache(object):
+    def __init__(self, pages=5, interval=30, min_interval=2):
+        self.pages = pages
+        self.interval = interval
+        self.min_interval = min_interval
+        self.snapshot = None
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if not self.pages:
+            return None
+        self.start()
+        return self.snapshot
+
+    def invalidate(self):
+        if self.thread is None:
+            self.snapshot = None
+        self.wakeup.set()
+
+    #Queries the newest posts (plus one to know if there are more) and renders
+    #them once per locale, in a request context of its own so it works from the thread
+    def refresh(self):
+        limit = self.pages * app.config['POSTS_PER_PAGE']
+        with app.app_context():
+            posts = replica(Post.query.options(db.selectinload(Post.author)).order_by(
+                Post.timestamp.desc(), Post.id.desc())).limit(limit + 1).all()
+            complete = len(posts) <= limit
+            posts = posts[:limit]
+            rows = {}
+            for locale in app.config['LANGUAGES']:
+                with app.test_request_context(headers={'Accept-Language': locale}):
+                    g.locale = locale
+                    rows[locale] = [render_post(post) for post in posts]
+            keys = [(post.timestamp, post.id) for post in posts]
+        self.snapshot = ExploreSnapshot(keys, rows, complete, time.time())
+        return self.snapshot
+
+    def start(self):
+        if not self.interval or self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    #Invalidations that arrive during a refresh set the event again, so they are
+    #picked up by one more refresh instead of being lost. That one waits until
+    #min_interval after the start of the last, all invalidations until then are
+    #merged into it
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception:
+                app.logger.exception('Explore cache refresh failed')
+            self.wakeup.wait(self.interval)
+            time.sleep(max(0, started + self.min_interval - time.monotonic()))
+
+explore_cache = ExploreCache(app.config['EXPLORE_CACHE_PAGES'], app.config['EXPLORE_CACHE_INTERVAL'],
+                             app.config['EXPLORE_CACHE_MIN_INTERVAL'])
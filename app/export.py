@@ -0,0 +1,89 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from flask import Response, stream_with_context
+from app import db
+from app.models import Post
+
+#Streaming CSV/JSONL exports and the matching imports
+#Rows come from a query run with yield_per, so the database hands them over in
+#batches and the response is written out as they arrive instead of being built
+#in memory first
+
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+#Rows per fetch from the database, and per chunk of the response
+CHUNK_ROWS = 1000
+
+#Rows of select as dicts of fields, fetched CHUNK_ROWS at a time on a server side
+#cursor where there is one. Timestamps are written as ISO 8601 UTC
+def stream_rows(session, select, fields):
+    result = session.execute(select.execution_options(yield_per=CHUNK_ROWS, stream_results=True))
+    for row in result:
+        yield {field: value.isoformat() + 'Z' if isinstance(value, datetime) else value
+               for field, value in zip(fields, row)}
+
+#A user's posts oldest first, a range scan on the (user_id, timestamp) index
+POST_FIELDS = ['id', 'timestamp', 'body', 'language']
+
+def post_rows(session, user_id):
+    return stream_rows(session, db.select(Post.id, Post.timestamp, Post.body, Post.language).where(
+        Post.user_id == user_id).order_by(Post.timestamp), POST_FIELDS)
+
+#Encodes rows (dicts) as text chunks of about CHUNK_ROWS rows each
+def encode(rows, fields, format):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields, extrasaction='ignore') if format == 'csv' else None
+    if writer is not None:
+        writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, default=str))
+            buffer.write('\n')
+        if count % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+#Compresses text chunks into a gzip file as they go by
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+#Chunked download of rows, the generator runs with the request's context so it can
+#use the session. With compress the download is a .gz file, compressed on the fly
+def export_response(rows, fields, format, filename, compress=False):
+    chunks = encode(rows, fields, format)
+    filename = '{}.{}'.format(filename, format)
+    if compress:
+        response = Response(stream_with_context(gzip_chunks(chunks)), mimetype='application/gzip')
+        filename += '.gz'
+    else:
+        response = Response(stream_with_context(chunks), mimetype=MIMETYPES[format])
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+#Values of field from a CSV (with a header row) or JSONL upload, blank lines skipped
+def read_field(text, field, format):
+    if format == 'csv':
+        return [row[field] for row in csv.DictReader(io.StringIO(text)) if row.get(field)]
+    values = []
+    for line in text.splitlines():
+        if line.strip():
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Expected one JSON object per line')
+            value = record.get(field)
+            if value:
+                values.append(value)
+    return values
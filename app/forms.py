@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired, ValidationError, Email, EqualTo, Length
-from app.models import User
+from app.uniqueness import uniqueness
+from flask import request
 from flask_babel import _, lazy_gettext as _l
 
 #Form to login
@@ -19,16 +20,15 @@ class RegistrationForm(FlaskForm):
     password2 = PasswordField(_l('Repeat Password'), validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField(_l('Register'))
 
-    #Queries database to check if username and email are already in use
+    #Checks if username and email are already in use, most free values are answered
+    #without a query (see app/uniqueness.py)
     #"validate_<fieldname>" is taken as custom validator for validate_on_submit()
     def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
+        if uniqueness.taken('username', username.data):
             raise ValidationError(_l('Username taken'))
     
     def validate_email(self, email):
-        email = User.query.filter_by(username=email.data).first()
-        if email is not None:
+        if uniqueness.taken('email', email.data):
             raise ValidationError(_l("Email already in use"))
 
 class PostForm(FlaskForm):
@@ -49,8 +49,7 @@ class EditProfileForm(FlaskForm):
     
     def validate_username(self, username):
         if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
+            if uniqueness.taken('username', username.data):
                 raise ValidationError(_l('Please use a different username'))
             
 #Form to reset password
@@ -67,4 +66,16 @@ class ResetPasswordForm(FlaskForm):
 #Implemented as POST request, safer
 #GET requests should only be on actions that do not introduce state changes
 class EmptyForm(FlaskForm):
-    submit = SubmitField(_l('Submit'))
\ No newline at end of file
+    submit = SubmitField(_l('Submit'))
+
+#Search box in the navbar, submitted with GET so no CSRF token and
+#data comes from the query string
+class SearchForm(FlaskForm):
+    q = StringField(_l('Search'), validators=[DataRequired()])
+
+    def __init__(self, *args, **kwargs):
+        if 'formdata' not in kwargs:
+            kwargs['formdata'] = request.args
+        if 'meta' not in kwargs:
+            kwargs['meta'] = {'csrf': False}
+        super(SearchForm, self).__init__(*args, **kwargs)
\ No newline at end of file
@@ -0,0 +1,24 @@
+from flask import render_template, g
+from markupsafe import Markup
+from app import app
+from app.cache import make_cache
+
+#Cache for rendered _post.html rows, keyed by post, locale and the author's
+#profile_version. edit_profile bumps the version so the old rows are never hit
+#again and get evicted like any other cold entry
+#The language is part of the key too since it is filled in after the post is
+#created and decides whether the Translate link shows
+fragment_cache = make_cache(app.config['FRAGMENT_CACHE'], app.config['FRAGMENT_CACHE_MAX_BYTES'],
+                            app.config['FRAGMENT_CACHE_PATH'])
+
+#Used by index.html and user.html in place of {% include '_post.html' %}
+@app.template_global()
+def render_post(post):
+    if fragment_cache is None:
+        return Markup(render_template('_post.html', post=post))
+    key = 'post:{}:{}:{}:{}'.format(post.id, g.locale, post.author.profile_version, post.language)
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template('_post.html', post=post)
+        fragment_cache.set(key, html)
+    return Markup(html)
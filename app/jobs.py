@@ -0,0 +1,261 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from app import app
+
+#Deferred work (mail, language detection, last_seen writes) goes through a queue
+#kept in a local SQLite file, so requests only insert a row and return, and
+#nothing needs a broker or any other service.
+#Functions are registered with @task under a name, enqueue(name, *args) stores
+#the JSON encoded arguments. Workers claim the highest priority job that is due,
+#run it and delete it; failures are retried with exponential backoff and marked
+#'dead' after JOB_MAX_ATTEMPTS tries. Tasks registered with batch=N get the
+#arguments of up to N due jobs in one call, as a list.
+#Run counts and timings per task are kept in the same file for "flask jobs stats"
+TASKS = {}
+
+#Functions registered with @on_worker_start run once per worker before it takes
+#any jobs (in each process of the 'process' pool), for slow one-off setup
+STARTUP = []
+
+class Task(object):
+    def __init__(self, f, name, priority=0, batch=None):
+        self.f = f
+        self.name = name
+        self.priority = priority
+        self.batch = batch
+
+def task(name, priority=0, batch=None):
+    def decorator(f):
+        TASKS[name] = Task(f, name, priority, batch)
+        return f
+    return decorator
+
+def on_worker_start(f):
+    STARTUP.append(f)
+    return f
+
+def prepare_worker():
+    for f in STARTUP:
+        f()
+
+#Raised by a batch task when only some of its jobs failed, failed holds their
+#positions in the batch. The others count as done and aren't run again
+class BatchError(Exception):
+    def __init__(self, failed, error):
+        super(BatchError, self).__init__(failed, error)
+        self.failed = failed
+        self.error = error
+
+#Top level so it can run in a process pool, args is a list of argument lists for batch tasks
+def run_task(name, args):
+    with app.app_context():
+        return TASKS[name].f(*args)
+
+class JobQueue(object):
+    STALE_CLAIM = 600
+
+    def __init__(self, path, workers=2, pool='thread', external=False, max_attempts=5, backoff=30, poll=1):
+        self.path = path
+        self.workers = workers
+        self.pool = pool
+        self.external = external
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll = poll
+        self.executor = None
+        self.local = threading.local()
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.prepared = False
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS job (id INTEGER PRIMARY KEY, name TEXT, args TEXT, '
+                         "priority INTEGER DEFAULT 0, status TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, "
+                         'next_attempt REAL, claimed REAL, error TEXT, created REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_job_status_priority ON job (status, priority, id)')
+            conn.execute('CREATE TABLE IF NOT EXISTS job_stat (name TEXT PRIMARY KEY, runs INTEGER DEFAULT 0, '
+                         'failures INTEGER DEFAULT 0, run_time REAL DEFAULT 0, max_run_time REAL DEFAULT 0, '
+                         'wait_time REAL DEFAULT 0)')
+            self.local.conn = conn
+        return conn
+
+    #Queues a call to the task registered as name, priority defaults to the task's
+    #(higher runs first), delay is in seconds
+    def enqueue(self, name, *args, priority=None, delay=0):
+        if priority is None:
+            priority = TASKS[name].priority
+        now = time.time()
+        self.connection().execute(
+            'INSERT INTO job (name, args, priority, next_attempt, created) VALUES (?, ?, ?, ?, ?)',
+            (name, json.dumps(args), priority, now + delay, now))
+        if not self.external:
+            self.start()
+            self.wakeup.set()
+
+    #Marks the highest priority due job 'running', along with more due jobs of the
+    #same task when it takes batches, and returns them as (name, rows).
+    #BEGIN IMMEDIATE keeps two workers (or processes) from claiming the same rows
+    def claim(self):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                "SELECT id, name, args, attempts, created FROM job WHERE status = 'queued' AND next_attempt <= ? "
+                'ORDER BY priority DESC, id LIMIT 1', (now,)).fetchall()
+            if rows and rows[0][1] in TASKS and TASKS[rows[0][1]].batch:
+                rows += conn.execute(
+                    "SELECT id, name, args, attempts, created FROM job WHERE status = 'queued' "
+                    'AND next_attempt <= ? AND name = ? AND id != ? ORDER BY id LIMIT ?',
+                    (now, rows[0][1], rows[0][0], TASKS[rows[0][1]].batch - 1)).fetchall()
+            conn.executemany("UPDATE job SET status = 'running', claimed = ? WHERE id = ?",
+                             [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return (rows[0][1], rows) if rows else None
+
+    #Runs claimed rows in the calling thread, or on the process pool when there is one
+    def execute(self, name, rows):
+        started = time.time()
+        try:
+            if name not in TASKS:
+                raise KeyError('No task registered as {!r}'.format(name))
+            args = [json.loads(row[2]) for row in rows]
+            args = [args] if TASKS[name].batch else args[0]
+            if self.executor is not None:
+                self.executor.submit(run_task, name, args).result()
+            else:
+                run_task(name, args)
+        except BatchError as e:
+            self.record(name, rows, started, e.error, [rows[i] for i in e.failed])
+        except Exception as e:
+            self.record(name, rows, started, e)
+        else:
+            self.record(name, rows, started)
+
+    #Deletes finished jobs or schedules the next attempt for failed ones (all of
+    #rows when there is an error and failed isn't given), and adds to the task's stats
+    def record(self, name, rows, started, error=None, failed=None):
+        now = time.time()
+        conn = self.connection()
+        if failed is None:
+            failed = rows if error is not None else []
+        failed_ids = {row[0] for row in failed}
+        conn.executemany('DELETE FROM job WHERE id = ?', [(row[0],) for row in rows if row[0] not in failed_ids])
+        if failed:
+            for id, _, args, attempts, created in failed:
+                attempts += 1
+                status = 'dead' if attempts >= self.max_attempts else 'queued'
+                conn.execute('UPDATE job SET status = ?, attempts = ?, next_attempt = ?, error = ? WHERE id = ?',
+                             (status, attempts, now + self.backoff * 2 ** (attempts - 1), repr(error), id))
+            app.logger.warning('Job %s failed for %d job(s): %r', name, len(failed), error)
+        conn.execute(
+            'INSERT INTO job_stat (name, runs, failures, run_time, max_run_time, wait_time) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET runs = runs + excluded.runs, failures = failures + excluded.failures, '
+            'run_time = run_time + excluded.run_time, max_run_time = max(max_run_time, excluded.max_run_time), '
+            'wait_time = wait_time + excluded.wait_time',
+            (name, len(rows), len(failed), now - started, now - started,
+             sum(started - row[4] for row in rows)))
+
+    #Runs everything that is due right now in the calling thread, returns the number of jobs claimed
+    def drain(self):
+        claimed = 0
+        while True:
+            found = self.claim()
+            if found is None:
+                return claimed
+            claimed += len(found[1])
+            self.execute(*found)
+
+    #Queued, running and dead jobs per task
+    def depth(self):
+        return self.connection().execute(
+            'SELECT name, status, count(*) FROM job GROUP BY name, status ORDER BY name, status').fetchall()
+
+    #(name, runs, failures, average and max run time, average wait) per task, times in seconds
+    def stats(self):
+        return self.connection().execute(
+            'SELECT name, runs, failures, run_time / runs, max_run_time, wait_time / runs FROM job_stat '
+            'WHERE runs > 0 ORDER BY name').fetchall()
+
+    def dead_letters(self):
+        return self.connection().execute(
+            "SELECT id, name, args, attempts, error FROM job WHERE status = 'dead' ORDER BY id").fetchall()
+
+    #Puts dead jobs back in the queue with a fresh set of attempts
+    def retry_dead(self):
+        count = self.connection().execute(
+            "UPDATE job SET status = 'queued', attempts = 0, next_attempt = ? WHERE status = 'dead'",
+            (time.time(),)).rowcount
+        self.wakeup.set()
+        return count
+
+    #Starts the worker threads once. With the 'process' pool the threads only hand
+    #jobs to a pool of as many processes and wait for them. Jobs left 'running' for
+    #longer than STALE_CLAIM seconds belong to a worker that died and are put back first
+    def start(self):
+        if self.threads:
+            return
+        with self.lock:
+            if self.threads:
+                return
+            self.connection().execute(
+                "UPDATE job SET status = 'queued' WHERE status = 'running' AND claimed < ?",
+                (time.time() - self.STALE_CLAIM,))
+            if self.pool == 'process':
+                self.executor = ProcessPoolExecutor(self.workers, initializer=prepare_worker)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    #Runs the @on_worker_start functions once for the worker threads of this process,
+    #from the first thread to get there rather than from the request that started them
+    def prepare(self):
+        with self.lock:
+            if not self.prepared:
+                prepare_worker()
+                self.prepared = True
+
+    def work(self):
+        if self.executor is None:
+            self.prepare()
+        while True:
+            try:
+                found = self.claim()
+            except sqlite3.Error:
+                app.logger.exception('Could not read the job queue')
+                found = None
+            if found is not None:
+                self.execute(*found)
+                continue
+            self.wakeup.wait(self.poll)
+            self.wakeup.clear()
+
+    #"flask worker": runs the workers in the foreground until interrupted
+    def serve(self):
+        self.start()
+        try:
+            for thread in self.threads:
+                thread.join()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+
+job_queue = JobQueue(app.config['JOB_QUEUE_PATH'], app.config['JOB_WORKERS'], app.config['JOB_POOL'],
+                     app.config['JOB_EXTERNAL_WORKER'], app.config['JOB_MAX_ATTEMPTS'],
+                     app.config['JOB_BACKOFF'], app.config['JOB_POLL'])
@@ -0,0 +1,68 @@
+from hashlib import md5
+from langdetect import DetectorFactory, detect, LangDetectException
+from langdetect.detector_factory import init_factory
+from app import app, db
+from app.cache import MemoryCache
+from app.models import Post
+from app.explore_cache import explore_cache
+from app.jobs import on_worker_start, task
+
+#langdetect is random unless seeded, same text should always give the same language
+DetectorFactory.seed = 0
+
+#Loads langdetect's profiles, slow (~0.5s) so it's done once per job worker up
+#front instead of inside the first detect_language job
+@on_worker_start
+def preload():
+    DetectorFactory.seed = 0
+    init_factory()
+
+#'' when the text can't be classified
+def detect_batch(texts):
+    languages = []
+    for text in texts:
+        try:
+            languages.append(detect(text))
+        except LangDetectException:
+            languages.append('')
+    return languages
+
+#Detects post languages off the request path
+#The index route queues a detect_language job per post, the job workers hand
+#up to LANGUAGE_DETECT_BATCH_SIZE of them to process() at once, which writes
+#Post.language back with one executemany UPDATE. Run "flask worker" with
+#JOB_POOL=process to keep detection off the web processes' cores.
+#Results are memoized by body so identical posts are only detected once
+class LanguageDetector(object):
+    def __init__(self, memo_bytes=1024 * 1024):
+        self.memo = MemoryCache(memo_bytes)
+
+    #Languages for texts, from the memo where possible
+    def detect(self, texts):
+        keys = [md5(text.encode('utf-8')).hexdigest() for text in texts]
+        languages = [self.memo.get(key) for key in keys]
+        missing = [i for i, language in enumerate(languages) if language is None]
+        if missing:
+            found = detect_batch([texts[i] for i in missing])
+            for i, language in zip(missing, found):
+                languages[i] = language
+                self.memo.set(keys[i], language)
+        return languages
+
+    #Detects and stores languages for a list of (post_id, body)
+    def process(self, batch):
+        languages = self.detect([body for post_id, body in batch])
+        with app.app_context():
+            db.session.execute(db.update(Post), [
+                {'id': post_id, 'language': language}
+                for (post_id, body), language in zip(batch, languages)])
+            db.session.commit()
+        #Rows in the explore snapshot decide on the Translate link by language
+        #(only reaches this process's snapshot, others catch up on their next refresh)
+        explore_cache.invalidate()
+
+language_detector = LanguageDetector()
+
+@task('detect_language', priority=-10, batch=app.config['LANGUAGE_DETECT_BATCH_SIZE'])
+def detect_languages(posts):
+    language_detector.process(posts)
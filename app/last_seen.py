@@ -0,0 +1,90 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from app import app, db
+from app.models import User, user_cache
+from app.jobs import job_queue, task
+
+#Keeps last_seen out of the request path
+#Requests only record a timestamp in memory, and only when it has moved past
+#LAST_SEEN_GRANULARITY seconds from what is already known. A background thread
+#queues the buffered timestamps as a job every LAST_SEEN_FLUSH_INTERVAL seconds
+#and a job worker writes them with one bulk UPDATE, so reads no longer turn
+#into write transactions
+class LastSeenTracker(object):
+    def __init__(self, queue=None):
+        self.queue = queue or job_queue
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def touch(self, user, now=None):
+        now = now or datetime.utcnow()
+        granularity = timedelta(seconds=app.config['LAST_SEEN_GRANULARITY'])
+        with self.lock:
+            last = self.pending.get(user.id) or user.last_seen
+            if last is not None and now - last < granularity:
+                return
+            self.pending[user.id] = now
+        self.start()
+
+    #Most recent time user was seen, including anything not written yet
+    def last_seen(self, user):
+        with self.lock:
+            pending = self.pending.get(user.id)
+        if pending is not None and (user.last_seen is None or pending > user.last_seen):
+            return pending
+        return user.last_seen
+
+    #Hands everything buffered to one write_last_seen job, returns number of users in it
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        try:
+            self.queue.enqueue('write_last_seen', [[id, seen.isoformat()] for id, seen in batch.items()])
+        except Exception:
+            app.logger.exception('Could not queue last_seen for %d users', len(batch))
+            #Put the batch back unless newer timestamps came in meanwhile
+            with self.lock:
+                for id, seen in batch.items():
+                    self.pending.setdefault(id, seen)
+            return 0
+        return len(batch)
+
+    #Starts the background flusher once, LAST_SEEN_FLUSH_INTERVAL of 0 disables it
+    #and leaves flushing to flush() and the exit hook
+    def start(self):
+        if not app.config['LAST_SEEN_FLUSH_INTERVAL'] or self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(app.config['LAST_SEEN_FLUSH_INTERVAL'])
+            self.flush()
+
+last_seen_tracker = LastSeenTracker()
+
+#Jobs queued by several flushes (from any process) are written together,
+#keeping the newest timestamp per user
+@task('write_last_seen', batch=100)
+def write_last_seen(batches):
+    seen = {}
+    for batch, in batches:
+        for id, timestamp in batch:
+            timestamp = datetime.fromisoformat(timestamp)
+            if id not in seen or timestamp > seen[id]:
+                seen[id] = timestamp
+    db.session.execute(db.update(User), [{'id': id, 'last_seen': timestamp} for id, timestamp in seen.items()])
+    for id in seen:
+        user_cache.expire(db.session, id)
+    db.session.commit()
+
+#Queues whatever is still buffered when the process shuts down
+atexit.register(last_seen_tracker.flush)
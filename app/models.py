@@ -1,11 +1,19 @@
 from app import db, login
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import validates, object_session
+from flask import g, has_app_context
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from array import array
+from bisect import bisect_left, insort
 from flask_login import UserMixin
 from hashlib import md5
 from time import time
 import jwt
 from app import app
+from app.passwords import password_hasher
+from app.cache import RowCache, make_cache
+from app.database import replica
 
 #flask db migrate -m "'table_name' table"
     #creates migration script
@@ -14,11 +22,51 @@ from app import app
 #flask db downgrade
     #undos last migration
 
+#insert() constructs with on_conflict_do_nothing(), by dialect name
+ON_CONFLICT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
 #Auxiliary table, no data other than foreign keys so doesn't need model class
+#Primary key on (follower_id, followed_id) covers "who does X follow" and stops duplicate edges,
+#the reverse index covers "who follows X"
 followers = db.Table(
     'followers', 
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')), 
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True), 
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'))
+
+#Precomputed home timeline, one row per (reader, post)
+#Filled on write (fan-out) so reading a page is a range scan over the primary key
+#instead of the join + union in computed_followed_posts()
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True))
+
+#Sorted array of ids, 8 bytes per id instead of a set entry's ~60,
+#membership is a binary search
+class IdSet(object):
+    def __init__(self, ids=()):
+        self.ids = array('q', sorted(ids))
+
+    def __contains__(self, id):
+        i = bisect_left(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, id):
+        if id not in self:
+            insort(self.ids, id)
+
+    def discard(self, id):
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            del self.ids[i]
 
 #UserMixin includes generic implementations that are appropriate for most user model classes
 class User(UserMixin, db.Model):
@@ -26,12 +74,24 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    #md5 of the lowercased email for Gravatar, set whenever email is
+    email_hash = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
     #One-to-many relationship defined on the one side, 
     #First argument is model class, backref is name of field added, lazy comes later
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    #Denormalized counts so profile pages don't run COUNT(*) queries,
+    #kept up to date by follow/unfollow and post inserts, "flask counters repair" fixes drift
+    followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    #Bumped whenever the profile changes, part of the cache key for rendered posts
+    profile_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    #When the user last followed, unfollowed or edited their profile, the API feed
+    #validators include it since those change feeds without adding a post
+    last_changed = db.Column(db.DateTime)
 
     #Many-to-many, 
     followed = db.relationship( 
@@ -42,29 +102,170 @@ class User(UserMixin, db.Model):
         backref=db.backref('followers', lazy='dynamic'),    #define how accessed from right side
         lazy='dynamic')
 
-    #Set and check password functions using werkzeug
+    #Set and check password functions, hashing happens on password_hasher's threads
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
+    #A correct password stored under old hashing parameters is rehashed with the
+    #current ones, the caller commits
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     #Uses Gravatar to generate random, unique geometric images to be used as avatar image
+    #The digest is stored with the user so rendering a feed only formats strings
+    AVATAR_URL = 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return self.AVATAR_URL.format(self.email_hash or User.hash_email(self.email), size)
+
+    @staticmethod
+    def hash_email(email):
+        return md5(email.lower().encode('utf-8')).hexdigest()
+
+    @validates('email')
+    def update_email_hash(self, key, email):
+        self.email_hash = User.hash_email(email) if email else None
+        return email
 
     #Following logic
     #Can use append and remove due to SQLAlchemy ORM
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.adjust_follow_counts(user, 1)
+            self.memoized_followed_ids(lambda ids: ids.add(user.id))
+            if app.config['TIMELINE_FANOUT']:
+                self.backfill_timeline(user)
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.adjust_follow_counts(user, -1)
+            self.memoized_followed_ids(lambda ids: ids.discard(user.id))
+            if app.config['TIMELINE_FANOUT']:
+                self.prune_timeline(user)
+
+    #Follows everyone in usernames that self doesn't follow yet, for importing a
+    #whole graph. Per chunk of FOLLOW_CHUNK names: one IN query resolves them, one
+    #multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING adds the edges and says
+    #which ones are new (so edges added concurrently aren't counted twice), and the
+    #counters (and timeline) are updated for those with one statement each.
+    #Databases without ON CONFLICT look the existing edges up first instead.
+    #Unknown names and self are skipped, returns the ids newly followed
+    FOLLOW_CHUNK = 500
+
+    def follow_many(self, usernames):
+        names = sorted(set(usernames))
+        insert = ON_CONFLICT_INSERTS.get(db.session.get_bind().dialect.name)
+        new = []
+        for i in range(0, len(names), self.FOLLOW_CHUNK):
+            ids = set(db.session.scalars(db.select(User.id).where(User.username.in_(names[i:i + self.FOLLOW_CHUNK]))))
+            ids.discard(self.id)
+            if insert is None:
+                ids -= set(db.session.scalars(db.select(followers.c.followed_id).where(
+                    followers.c.follower_id == self.id, followers.c.followed_id.in_(ids))))
+            if not ids:
+                continue
+            rows = [{'follower_id': self.id, 'followed_id': id} for id in sorted(ids)]
+            if insert is None:
+                db.session.execute(followers.insert().values(rows))
+                chunk = sorted(ids)
+            else:
+                chunk = sorted(db.session.scalars(insert(followers).values(rows).on_conflict_do_nothing().returning(
+                    followers.c.followed_id)))
+                if not chunk:
+                    continue
+            db.session.execute(db.update(User).where(User.id.in_(chunk)).values(
+                followers_count=User.followers_count + 1))
+            if app.config['TIMELINE_FANOUT']:
+                posts = db.select(db.literal(self.id), Post.timestamp, Post.id).where(Post.user_id.in_(chunk))
+                db.session.execute(timeline.insert().from_select(['user_id', 'timestamp', 'post_id'], posts))
+            new.extend(chunk)
+        if not new:
+            return new
+        db.session.execute(db.update(User).where(User.id == self.id).values(
+            followed_count=User.followed_count + len(new), last_changed=datetime.utcnow()))
+        for id in [self.id] + new:
+            user_cache.expire(db.session, id)
+        def add_all(memo):
+            for id in new:
+                memo.add(id)
+        self.memoized_followed_ids(add_all)
+        return new
+
+    #Answered from the followed id memo when it has been loaded this request,
+    #otherwise an EXISTS query that stops at the first matching row
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        ids = self.memoized_followed_ids()
+        if ids is not None:
+            return user.id in ids
+        return db.session.scalar(db.select(db.exists().where(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id)))
+
+    #Ids of everyone self follows, loaded with one query the first time it's needed
+    #and kept on g for the rest of the request, so pages listing many users can
+    #check "am I following X" without a query per user
+    def followed_ids(self):
+        ids = self.memoized_followed_ids()
+        if ids is None:
+            ids = IdSet(db.session.scalars(
+                db.select(followers.c.followed_id).where(followers.c.follower_id == self.id)))
+            g.setdefault('followed_ids', {})[self.id] = ids
+        return ids
+
+    #Returns the memo for self if it's loaded (None if not), applying update to it first
+    def memoized_followed_ids(self, update=None):
+        if not has_app_context():
+            return None
+        ids = g.get('followed_ids', {}).get(self.id)
+        if ids is not None and update is not None:
+            update(ids)
+        return ids
 
+    #Counters are changed with UPDATE ... SET n = n + delta in the same transaction
+    #as the follow itself, so concurrent follows can't overwrite each other
+    def adjust_follow_counts(self, user, delta):
+        db.session.execute(db.update(User).where(User.id == self.id).values(
+            followed_count=User.followed_count + delta, last_changed=datetime.utcnow()))
+        db.session.execute(db.update(User).where(User.id == user.id).values(
+            followers_count=User.followers_count + delta))
+        user_cache.expire(db.session, self.id)
+        user_cache.expire(db.session, user.id)
+
+    #Recomputes all counters from the followers and post tables in one UPDATE,
+    #only touching rows that drifted, returns how many users were fixed
+    @staticmethod
+    def repair_counts():
+        counts = {
+            'followers_count': db.select(db.func.count()).where(
+                followers.c.followed_id == User.id).scalar_subquery(),
+            'followed_count': db.select(db.func.count()).where(
+                followers.c.follower_id == User.id).scalar_subquery(),
+            'posts_count': db.select(db.func.count(Post.id)).where(
+                Post.user_id == User.id).scalar_subquery()}
+        drifted = db.or_(*[getattr(User, name) != count for name, count in counts.items()])
+        result = db.session.execute(db.update(User).where(drifted).values(**counts).execution_options(
+            synchronize_session=False))
+        return result.rowcount
+
+    #Home feed, read from the timeline table when fan-out is on
+    #otherwise falls back to computing it from followers and posts
+    #Both can be served from the read engine
     def followed_posts(self):
+        if app.config['TIMELINE_FANOUT']:
+            return replica(self.timeline_posts())
+        return replica(self.computed_followed_posts())
+
+    #Columns followed_posts() is ordered by, needed for cursor pagination
+    @staticmethod
+    def followed_posts_keys():
+        if app.config['TIMELINE_FANOUT']:
+            return timeline.c.timestamp, timeline.c.post_id
+        return Post.timestamp, Post.id
+
+    def computed_followed_posts(self):
         # join on followers and Post table by condition where followed_id == user_id
         #filter where only results are where self is following
         #order by timestamp
@@ -75,7 +276,43 @@ class User(UserMixin, db.Model):
         #Query for own posts
         own = Post.query.filter_by(user_id=self.id)
         #Union for followed and own posts
-        return followed.union(own).order_by(Post.timestamp.desc())
+        #authors are loaded in one extra query for the whole page instead of one per post
+        return followed.union(own).options(db.selectinload(Post.author)).order_by(Post.timestamp.desc())
+
+    def timeline_posts(self):
+        return Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id).options(db.selectinload(Post.author)).order_by(
+                timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
+    #Copies all of user's posts into self's timeline, used right after following
+    def backfill_timeline(self, user):
+        posts = db.select(
+            db.literal(self.id), Post.timestamp, Post.id).where(Post.user_id == user.id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'timestamp', 'post_id'], posts))
+
+    #Opposite of above, removes user's posts from self's timeline
+    def prune_timeline(self, user):
+        posts = db.select(Post.id).where(Post.user_id == user.id)
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id, timeline.c.post_id.in_(posts)))
+
+    #Rebuilds self's timeline from scratch using the computed query
+    def rebuild_timeline(self):
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id))
+        posts = db.select(db.literal(self.id), Post.timestamp, Post.id).where(
+            db.or_(Post.user_id == self.id, Post.user_id.in_(
+                db.select(followers.c.followed_id).where(followers.c.follower_id == self.id))))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'timestamp', 'post_id'], posts))
+
+    #Consistency check between the timeline table and the computed query
+    #returns (post ids missing from timeline, post ids that shouldn't be there)
+    def timeline_drift(self):
+        expected = {p.id for p in self.computed_followed_posts()}
+        stored = set(db.session.scalars(
+            db.select(timeline.c.post_id).where(timeline.c.user_id == self.id)))
+        return expected - stored, stored - expected
     
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -96,19 +333,60 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
 class Post(db.Model):
+    #A user's posts newest first (profile pages, feed joins) is a range scan on this index
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id')) #Foreign key, references id value from user table
     language = db.Column(db.String(5))
 
+    #Pushes the post into the timelines of the author and all of their followers
+    #in a single INSERT ... SELECT, needs the post flushed so id and timestamp are set
+    def fan_out(self):
+        if not app.config['TIMELINE_FANOUT']:
+            return
+        db.session.flush()
+        readers = db.select(followers.c.follower_id).where(
+            followers.c.followed_id == self.user_id).union(db.select(db.literal(self.user_id)))
+        rows = db.select(
+            readers.subquery().c[0],
+            db.literal(self.timestamp, db.DateTime),
+            db.literal(self.id))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'timestamp', 'post_id'], rows))
+
     #Print function for debugging
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+#Keeps User.posts_count in step with the post table, runs inside the flush
+#so the count changes in the same transaction as the insert/delete
+@event.listens_for(Post, 'after_insert')
+def count_new_post(mapper, connection, post):
+    connection.execute(db.update(User.__table__).where(User.__table__.c.id == post.user_id).values(
+        posts_count=User.__table__.c.posts_count + 1))
+    user_cache.expire(object_session(post), post.user_id)
+
+@event.listens_for(Post, 'after_delete')
+def count_deleted_post(mapper, connection, post):
+    connection.execute(db.update(User.__table__).where(User.__table__.c.id == post.user_id).values(
+        posts_count=User.__table__.c.posts_count - 1))
+    user_cache.expire(object_session(post), post.user_id)
+
+#User rows for load_user, kept USER_CACHE_TTL seconds so a logged in request doesn't
+#start with a primary key query. Dropped whenever the user is written through the
+#session, the counter updates above and the last_seen writer expire them explicitly
+#The password hash isn't cached, it's loaded if check_password is ever called on one
+user_cache = RowCache(User, make_cache(app.config['USER_CACHE'], app.config['USER_CACHE_MAX_BYTES'],
+                                       app.config['USER_CACHE_PATH']),
+                      app.config['USER_CACHE_TTL'], exclude=('password_hash',))
+user_cache.listen(db.session)
+
 #Flask-Login retrieves id of actice user from session
-#from the database
+#from the cache or the database
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.get(db.session, int(id))
 
@@ -0,0 +1,67 @@
+import base64
+from datetime import datetime
+from app import db
+from app.models import Post
+
+#Keyset (cursor) pagination for feeds ordered newest first by (timestamp, id)
+#Each page seeks past the last row of the page before it instead of using OFFSET,
+#so deep pages cost the same as page 1 and no COUNT query is needed
+
+class CursorPage(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+#Cursors are opaque to clients: direction ('n' older, 'p' newer) plus the key
+#of the row to seek from, base64 encoded for use in query strings
+def encode_cursor(direction, timestamp, id):
+    raw = '{}|{}|{}'.format(direction, timestamp.isoformat(), id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+#Returns (direction, timestamp, id) or None for anything malformed
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        direction, timestamp, id = raw.split('|')
+        if direction not in ('n', 'p'):
+            return None
+        return direction, datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+#keys are the (timestamp, id) columns the query is ordered by, defaults to Post's own
+#Fetches one row more than needed to know if there is another page in that direction
+def paginate_cursor(query, cursor, per_page, keys=None):
+    ts_col, id_col = keys or (Post.timestamp, Post.id)
+    decoded = decode_cursor(cursor) if cursor else None
+    query = query.order_by(None)
+    if decoded is None:
+        items = query.order_by(ts_col.desc(), id_col.desc()).limit(per_page + 1).all()
+        has_newer, has_older = False, len(items) > per_page
+        items = items[:per_page]
+    elif decoded[0] == 'n':
+        _, timestamp, id = decoded
+        items = query.filter(db.or_(ts_col < timestamp, db.and_(ts_col == timestamp, id_col < id))).order_by(
+            ts_col.desc(), id_col.desc()).limit(per_page + 1).all()
+        has_newer, has_older = True, len(items) > per_page
+        items = items[:per_page]
+    else:
+        _, timestamp, id = decoded
+        items = query.filter(db.or_(ts_col > timestamp, db.and_(ts_col == timestamp, id_col > id))).order_by(
+            ts_col.asc(), id_col.asc()).limit(per_page + 1).all()
+        has_newer, has_older = len(items) > per_page, True
+        items = items[:per_page][::-1]
+    if not items:
+        return CursorPage(items)
+    next_cursor = encode_cursor('n', items[-1].timestamp, items[-1].id) if has_older else None
+    prev_cursor = encode_cursor('p', items[0].timestamp, items[0].id) if has_newer else None
+    return CursorPage(items, next_cursor, prev_cursor)
@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from app import app
+
+class HashingBusy(Exception):
+    pass
+
+#Password hashing under a configurable policy (PASSWORD_HASH_METHOD/PASSWORD_SALT_LENGTH)
+#Hashes are computed on a pool of PASSWORD_HASH_WORKERS threads so no more than
+#that many cores are ever busy hashing. At most PASSWORD_HASH_QUEUE more calls
+#wait for a thread, anything past that fails fast with HashingBusy instead of
+#tying up a request worker
+class PasswordHasher(object):
+    def __init__(self, method='pbkdf2:sha256', salt_length=16, workers=2, queue=16):
+        #Werkzeug leaves the default iteration count out of the method but writes it into hashes
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method += ':{}'.format(DEFAULT_PBKDF2_ITERATIONS)
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def executor(self):
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='password')
+        return self.pool
+
+    def run(self, f, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return self.executor().submit(f, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        if not password_hash:
+            return False
+        return self.run(check_password_hash, password_hash, password)
+
+    #True when password_hash was made under different parameters than the current policy
+    def needs_rehash(self, password_hash):
+        if not password_hash or password_hash.count('$') != 2:
+            return True
+        method, salt, hashval = password_hash.split('$')
+        return method != self.method or len(salt) != self.salt_length
+
+#Sliding window of recent attempts per key: allow() is False once a key has limit
+#attempts in the last window seconds. Only the newest limit timestamps are kept per key
+class MemoryLimiter(object):
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.hits = {}
+        self.lock = threading.Lock()
+        self.clock = time.time
+
+    def allow(self, key):
+        now = self.clock()
+        with self.lock:
+            hits = self.hits.get(key)
+            return hits is None or len(hits) < self.limit or hits[0] <= now - self.window
+
+    def hit(self, key):
+        now = self.clock()
+        with self.lock:
+            hits = self.hits.get(key)
+            if hits is None:
+                hits = self.hits[key] = deque(maxlen=self.limit)
+                #Keys nobody has used for a whole window are dropped now and then
+                if len(self.hits) % 1024 == 0:
+                    self.prune(now)
+            hits.append(now)
+
+    def reset(self, key):
+        with self.lock:
+            self.hits.pop(key, None)
+
+    def prune(self, now):
+        for key in [key for key, hits in self.hits.items() if hits and hits[-1] <= now - self.window]:
+            del self.hits[key]
+
+#Same, kept in a local SQLite file so every worker process on the box shares the counts
+class SQLiteLimiter(object):
+    def __init__(self, path, limit, window):
+        self.path = path
+        self.limit = limit
+        self.window = window
+        self.local = threading.local()
+        self.clock = time.time
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS hit (key TEXT, time REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_hit_key_time ON hit (key, time)')
+            self.local.conn = conn
+        return conn
+
+    def allow(self, key):
+        count = self.connection().execute('SELECT count(*) FROM hit WHERE key = ? AND time > ?',
+                                          (key, self.clock() - self.window)).fetchone()[0]
+        return count < self.limit
+
+    def hit(self, key):
+        now = self.clock()
+        conn = self.connection()
+        conn.execute('INSERT INTO hit (key, time) VALUES (?, ?)', (key, now))
+        conn.execute('DELETE FROM hit WHERE key = ? AND time <= ?', (key, now - self.window))
+
+    def reset(self, key):
+        self.connection().execute('DELETE FROM hit WHERE key = ?', (key,))
+
+#Failed logins are limited per username and, more loosely, per client address
+#Both are checked before the password is looked at, so rejected attempts cost no hashing
+class LoginLimiter(object):
+    def __init__(self, per_user, per_ip):
+        self.per_user = per_user
+        self.per_ip = per_ip
+
+    def keys(self, username, ip):
+        return [(self.per_user, 'user:' + (username or '').lower()), (self.per_ip, 'ip:{}'.format(ip))]
+
+    def allow(self, username, ip):
+        return all(limiter.allow(key) for limiter, key in self.keys(username, ip))
+
+    def failed(self, username, ip):
+        for limiter, key in self.keys(username, ip):
+            limiter.hit(key)
+
+    def succeeded(self, username, ip):
+        self.per_user.reset('user:' + (username or '').lower())
+
+def make_limiter(backend, limit, window, path=None):
+    if backend == 'sqlite':
+        return SQLiteLimiter(path, limit, window)
+    return MemoryLimiter(limit, window)
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'],
+                                 app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+
+login_limiter = LoginLimiter(
+    make_limiter(app.config['LOGIN_LIMITER'], app.config['LOGIN_ATTEMPTS_PER_USER'],
+                 app.config['LOGIN_ATTEMPTS_WINDOW'], app.config['LOGIN_LIMITER_PATH']),
+    make_limiter(app.config['LOGIN_LIMITER'], app.config['LOGIN_ATTEMPTS_PER_IP'],
+                 app.config['LOGIN_ATTEMPTS_WINDOW'], app.config['LOGIN_LIMITER_PATH']))
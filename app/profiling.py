@@ -0,0 +1,208 @@
+import threading
+import time
+from flask import g, has_request_context, request, request_started, request_finished, \
+    before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app, db
+
+#Counts the SQL statements sent to the database while active
+#with QueryCounter() as queries:
+#    ...
+#queries.count, queries.statements
+class QueryCounter(object):
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.engine = self.engine or db.engine
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+#Opt-in per request profiling (PROFILING=1)
+#Times every statement on any engine and the templates rendered during a request,
+#then for each response:
+#- adds a Server-Timing header (db time and query count, template time, total)
+#- logs a line to app.logger (so the RotatingFileHandler log), with the slowest
+#  statements when the request took longer than PROFILING_SLOW_MS
+#- adds it to per endpoint totals served in Prometheus format at /_metrics
+#Work done outside a request (background flushes, CLI commands) isn't recorded
+class RequestProfiler(object):
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    STATEMENT_LENGTH = 200
+
+    def __init__(self, top=5, slow_ms=500):
+        self.top = top
+        self.slow_ms = slow_ms
+        self.installed = False
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def install(self):
+        if self.installed:
+            return
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(Engine, 'handle_error', self.handle_error)
+        request_started.connect(self.request_started, app)
+        request_finished.connect(self.request_finished, app)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.after_render, app)
+        self.installed = True
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.remove(Engine, 'handle_error', self.handle_error)
+        request_started.disconnect(self.request_started, app)
+        request_finished.disconnect(self.request_finished, app)
+        before_render_template.disconnect(self.before_render, app)
+        template_rendered.disconnect(self.after_render, app)
+        self.installed = False
+
+    #State of the request being handled, None outside requests
+    def current(self):
+        if not has_request_context():
+            return None
+        return g.get('profile')
+
+    def request_started(self, sender, **extra):
+        g.profile = {'start': time.perf_counter(), 'queries': 0, 'db': 0.0,
+                     'template': 0.0, 'depth': 0, 'statements': []}
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profile_start'].pop()
+        profile = self.current()
+        if profile is None:
+            return
+        profile['queries'] += 1
+        profile['db'] += elapsed
+        profile['statements'].append((elapsed, statement))
+
+    #A failed statement never gets to after_cursor_execute, its start time is
+    #dropped here so the next statement on the connection isn't timed from it
+    def handle_error(self, context):
+        conn = context.connection
+        if conn is not None and context.execution_context is not None and conn.info.get('profile_start'):
+            conn.info['profile_start'].pop()
+
+    #Templates include and render other templates (render_post), only the
+    #outermost render is timed so nothing is counted twice
+    def before_render(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is None:
+            return
+        if profile['depth'] == 0:
+            profile['template_start'] = time.perf_counter()
+        profile['depth'] += 1
+
+    def after_render(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is None or not profile['depth']:
+            return
+        profile['depth'] -= 1
+        if profile['depth'] == 0:
+            profile['template'] += time.perf_counter() - profile['template_start']
+
+    def request_finished(self, sender, response, **extra):
+        profile = self.current()
+        if profile is None:
+            return
+        total = time.perf_counter() - profile['start']
+        slowest = sorted(profile['statements'], key=lambda item: item[0], reverse=True)[:self.top]
+        response.headers['Server-Timing'] = 'db;dur={:.2f};desc="{} queries", tpl;dur={:.2f}, total;dur={:.2f}'.format(
+            profile['db'] * 1000, profile['queries'], profile['template'] * 1000, total * 1000)
+        endpoint = request.endpoint or 'none'
+        app.logger.info('%s %s %s endpoint=%s total=%.1fms db=%.1fms queries=%d template=%.1fms',
+                        request.method, request.path, response.status_code, endpoint, total * 1000,
+                        profile['db'] * 1000, profile['queries'], profile['template'] * 1000)
+        if total * 1000 >= self.slow_ms:
+            for elapsed, statement in slowest:
+                app.logger.warning('Slow request %s, %.1fms in: %s', request.path, elapsed * 1000,
+                                   ' '.join(statement.split()))
+        self.add(endpoint, total, profile['queries'], profile['db'], profile['template'], slowest)
+
+    #Adds a finished request to the per endpoint totals
+    def add(self, endpoint, total, queries, db_time, template, statements):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0, 'duration': 0.0, 'buckets': [0] * len(self.BUCKETS),
+                    'queries': 0, 'db': 0.0, 'template': 0.0, 'slowest': {}}
+            stats['requests'] += 1
+            stats['duration'] += total
+            for i, bound in enumerate(self.BUCKETS):
+                if total <= bound:
+                    stats['buckets'][i] += 1
+            stats['queries'] += queries
+            stats['db'] += db_time
+            stats['template'] += template
+            #Slowest distinct statements seen on this endpoint, the text is cut down
+            #to STATEMENT_LENGTH for the metric label
+            slowest = stats['slowest']
+            for elapsed, statement in statements:
+                statement = ' '.join(statement.split())[:self.STATEMENT_LENGTH]
+                slowest[statement] = max(elapsed, slowest.get(statement, 0))
+            if len(slowest) > self.top:
+                stats['slowest'] = dict(sorted(slowest.items(), key=lambda item: item[1], reverse=True)[:self.top])
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    #Totals in the Prometheus text exposition format
+    def metrics(self):
+        with self.lock:
+            endpoints = {name: dict(stats, buckets=list(stats['buckets']), slowest=dict(stats['slowest']))
+                         for name, stats in self.endpoints.items()}
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP microblog_{} {}'.format(name, help))
+            lines.append('# TYPE microblog_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('microblog_{}{}{{{}}} {}'.format(name, suffix, ','.join(
+                    '{}="{}"'.format(key, escape_label(value)) for key, value in labels), value))
+        metric('requests_total', 'counter', 'Requests handled.',
+               [('', [('endpoint', name)], stats['requests']) for name, stats in endpoints.items()])
+        samples = []
+        for name, stats in endpoints.items():
+            for bound, count in zip(self.BUCKETS, stats['buckets']):
+                samples.append(('_bucket', [('endpoint', name), ('le', str(bound))], count))
+            samples.append(('_bucket', [('endpoint', name), ('le', '+Inf')], stats['requests']))
+            samples.append(('_sum', [('endpoint', name)], stats['duration']))
+            samples.append(('_count', [('endpoint', name)], stats['requests']))
+        metric('request_duration_seconds', 'histogram', 'Time spent handling requests.', samples)
+        metric('db_queries_total', 'counter', 'SQL statements executed.',
+               [('', [('endpoint', name)], stats['queries']) for name, stats in endpoints.items()])
+        metric('db_duration_seconds_total', 'counter', 'Time spent executing SQL.',
+               [('', [('endpoint', name)], stats['db']) for name, stats in endpoints.items()])
+        metric('template_duration_seconds_total', 'counter', 'Time spent rendering templates.',
+               [('', [('endpoint', name)], stats['template']) for name, stats in endpoints.items()])
+        metric('slowest_query_seconds', 'gauge', 'Slowest SQL statements seen per endpoint.',
+               [('', [('endpoint', name), ('statement', statement)], elapsed)
+                for name, stats in endpoints.items() for statement, elapsed in stats['slowest'].items()])
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_profiler = RequestProfiler(app.config['PROFILING_TOP_QUERIES'], app.config['PROFILING_SLOW_MS'])
+if app.config['PROFILING']:
+    request_profiler.install()
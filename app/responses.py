@@ -0,0 +1,90 @@
+import gzip
+import secrets
+from hashlib import md5
+from flask import g, request, session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from app import app
+from app.cache import make_cache
+
+#brotli is optional, gzip is used when it isn't installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#Last step for every response:
+#- the logged out login/register/reset_password_request pages are cached per locale
+#  and served again without running the view or rendering anything
+#- GET responses get a weak ETag of their body and turn into a 304 when the
+#  client already has it (responses with their own ETag, like the API's, keep theirs)
+#- text responses of RESPONSE_COMPRESS_MIN_BYTES or more are compressed with brotli
+#  or gzip, whichever the client accepts (brotli first unless RESPONSE_COMPRESSION is 'gzip')
+#Streamed responses (exports) and files are left alone
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                'application/json'}
+CACHED_PAGES = {'login', 'register', 'reset_password_request'}
+
+page_cache = make_cache(app.config['PAGE_CACHE'], app.config['PAGE_CACHE_MAX_BYTES'], app.config['PAGE_CACHE_PATH'])
+
+#Cached pages are rendered with this in place of the CSRF token, each response
+#gets its own token put back in. Flask-WTF takes the token from g when it's there
+CSRF_SENTINEL = 'csrf-sentinel-{}'.format(secrets.token_hex(16))
+
+#Pages with flashed messages differ per visitor and aren't cached
+def cacheable_page():
+    return (page_cache is not None and request.method == 'GET' and request.endpoint in CACHED_PAGES and
+            not current_user.is_authenticated and '_flashes' not in session)
+
+def page_key():
+    return 'page:{}:{}'.format(request.endpoint, g.locale)
+
+def with_csrf_token(html):
+    g.pop(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), None)
+    return html.replace(CSRF_SENTINEL, generate_csrf())
+
+#Registered after routes' before_request, so g.locale is set
+@app.before_request
+def serve_cached_page():
+    if not cacheable_page():
+        return None
+    html = page_cache.get(page_key())
+    if html is None:
+        g.page_cache_miss = True
+        setattr(g, app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), CSRF_SENTINEL)
+        return None
+    return app.response_class(with_csrf_token(html), mimetype='text/html')
+
+def compress(response):
+    if response.mimetype not in COMPRESSIBLE or 'Content-Encoding' in response.headers:
+        return
+    data = response.get_data()
+    if len(data) < app.config['RESPONSE_COMPRESS_MIN_BYTES']:
+        return
+    response.vary.add('Accept-Encoding')
+    encodings = request.accept_encodings
+    if brotli is not None and app.config['RESPONSE_COMPRESSION'] == 'auto' and encodings['br']:
+        response.set_data(brotli.compress(data, quality=app.config['RESPONSE_BROTLI_QUALITY']))
+        response.headers['Content-Encoding'] = 'br'
+    elif encodings['gzip']:
+        response.set_data(gzip.compress(data, app.config['RESPONSE_GZIP_LEVEL'], mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+
+@app.after_request
+def finish_response(response):
+    if g.pop('page_cache_miss', False):
+        html = response.get_data(as_text=True)
+        if response.status_code == 200 and '_flashes' not in session:
+            page_cache.set(page_key(), html, ttl=app.config['PAGE_CACHE_TTL'])
+        response.set_data(with_csrf_token(html))
+    if response.is_streamed or response.direct_passthrough or response.status_code != 200:
+        return response
+    if request.method in ('GET', 'HEAD') and 'ETag' not in response.headers:
+        response.set_etag(md5(response.get_data()).hexdigest(), weak=True)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if app.config['RESPONSE_COMPRESSION'] != 'none':
+        compress(response)
+    return response
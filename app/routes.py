@@ -1,13 +1,25 @@
 from app import app, db
-from flask import render_template, flash, redirect, url_for, request, g
-from app.models import User, Post
-from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, abort
+from app.models import User, Post, followers
+from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm, SearchForm
 from flask_login import current_user, login_user, logout_user, login_required
 from werkzeug.urls import url_parse
 from datetime import datetime
+import hmac
 from app.email import send_password_reset_email
-from flask_babel import get_locale
-from langdetect import detect, LangDetectException
+from app.pagination import paginate_cursor
+from app.last_seen import last_seen_tracker
+from flask_babel import get_locale, _
+from app.jobs import job_queue
+from app.translate import translator, TranslationError
+from app.search import search_posts, search_users
+from app.profiling import request_profiler
+from app.passwords import login_limiter
+from app.uniqueness import uniqueness
+from app.database import replica
+from app.explore_cache import explore_cache
+from app.export import MIMETYPES, POST_FIELDS, export_response, post_rows, stream_rows
+from sqlalchemy.exc import IntegrityError
 
 #Different pages
 #Added methods for post form
@@ -18,36 +30,52 @@ def index():
     #Can do pythonic stuff here and then pass to html page
     form = PostForm()
     if form.validate_on_submit():
-        #Attempts to detect language from post
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ""
         #Create post and push to database
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        #Pushes post to followers' timelines, does nothing if fan-out is off
+        post.fan_out()
         db.session.commit()
+        #Language is detected by a job worker and saved to the post when done
+        job_queue.enqueue('detect_language', post.id, post.body)
+        explore_cache.invalidate()
         flash("Post now live")
         #Standard practice to respond to post request with redirect
         #Post/Redirect/Get pattern
         return redirect(url_for('index'))
-    #request args accesses arguments given in query string
-    page = request.args.get('page', 1, type=int)
-    #gets Pagination object, contains list of items of requested page
-    #Can use attributes of Pag. object for navigation
-    posts = current_user.followed_posts().paginate(page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    #url_for auto applies keyword arguments to URL
-    next_url = url_for('index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Home Page', posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    posts, next_url, prev_url = paginate_posts(
+        current_user.followed_posts(), 'index', keys=current_user.followed_posts_keys())
+    return render_template('index.html', title='Home Page', posts=posts, form=form, next_url=next_url, prev_url=prev_url)
+
+#Pages a post query and builds the next/prev links used by the pager in index.html and user.html
+#Cursor mode seeks by (timestamp, id) so there is no OFFSET scan or COUNT query,
+#offset mode keeps the old ?page=N behaviour
+#kwargs are passed on to url_for for the links
+def paginate_posts(query, endpoint, keys=None, **kwargs):
+    per_page = app.config['POSTS_PER_PAGE']
+    if app.config['POSTS_PAGINATION'] == 'offset':
+        #request args accesses arguments given in query string
+        page = request.args.get('page', 1, type=int)
+        #gets Pagination object, contains list of items of requested page
+        #Can use attributes of Pag. object for navigation
+        posts = query.paginate(page=page, per_page=per_page, error_out=False)
+        #url_for auto applies keyword arguments to URL
+        next_url = url_for(endpoint, page=posts.next_num, **kwargs) if posts.has_next else None
+        prev_url = url_for(endpoint, page=posts.prev_num, **kwargs) if posts.has_prev else None
+        return posts.items, next_url, prev_url
+    posts = paginate_cursor(query, request.args.get('cursor'), per_page, keys)
+    next_url = url_for(endpoint, cursor=posts.next_cursor, **kwargs) if posts.has_next else None
+    prev_url = url_for(endpoint, cursor=posts.prev_cursor, **kwargs) if posts.has_prev else None
+    return posts.items, next_url, prev_url
 
 #before_request executed right before view function
-#checks if user is logged in, sets last_seen and updates database
+#checks if user is logged in and records last_seen,
+#the tracker writes it to the database later in batches
 @app.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen_tracker.touch(current_user)
+        g.search_form = SearchForm()
     g.locale = str(get_locale());
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -58,11 +86,21 @@ def login():
         return redirect(url_for('index'))
     form = LoginForm()
     if form.validate_on_submit():
+        #Too many recent failures for this username or address, turned away
+        #before the database lookup or any password hashing
+        username, ip = form.username.data, request.remote_addr
+        if not login_limiter.allow(username, ip):
+            flash('Too many failed login attempts, please try again later')
+            return render_template('login.html', title='Sign in', form=form), 429
         #Queries the database for correct username
-        user = User.query.filter_by(username=form.username.data).first()
+        user = User.query.filter_by(username=username).first()
         if user is None or not user.check_password(form.password.data):
+            login_limiter.failed(username, ip)
             flash('Invalid username or password')
             return redirect(url_for('login'))
+        login_limiter.succeeded(username, ip)
+        #Saves the password if check_password rehashed it
+        db.session.commit()
         #login_user from Flask-Login
         login_user(user, remember=form.remember_me.data)
 
@@ -91,7 +129,17 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+        #The form's checks can miss a name taken moments ago, the unique
+        #constraints have the last word
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if uniqueness.exists('username', form.username.data):
+                form.username.errors.append(_('Username taken'))
+            if uniqueness.exists('email', form.email.data):
+                form.email.errors.append(_('Email already in use'))
+            return render_template('register.html', title='Register', form=form)
         flash("Registration success!")
         return redirect(url_for('index'))
     return render_template('register.html', title='Register', form=form)
@@ -103,13 +151,43 @@ def register():
 def user(username):
     #Queries database for username
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('user', username=user.username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    #All posts here are by user, who is already in the session, so post.author
+    #is served from the identity map without any extra query
+    posts, next_url, prev_url = paginate_posts(
+        user.posts.order_by(Post.timestamp.desc()), 'user', username=user.username)
     #EmptyForm acts as unfollow button
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url, form=form)
+    return render_template('user.html', user=user, posts=posts, next_url=next_url, prev_url=prev_url, form=form,
+                           last_seen=last_seen_tracker.last_seen(user))
+
+#Streams the accounts a user follows or is followed by as CSV or JSONL, in the
+#order of the followers index so no sort is needed. Only for your own account
+@app.route('/user/<username>/<any(followers, following):relation>.<any(csv, jsonl):format>')
+@login_required
+def export_follows(username, relation, format):
+    if username != current_user.username:
+        abort(403)
+    if relation == 'followers':
+        own, other = followers.c.followed_id, followers.c.follower_id
+    else:
+        own, other = followers.c.follower_id, followers.c.followed_id
+    query = db.select(User.username).join(followers, User.id == other).where(own == current_user.id).order_by(other)
+    return export_response(stream_rows(db.session, query, ['username']), ['username'], format,
+                           '{}-{}'.format(username, relation))
+
+#All of a user's posts, oldest first, as JSONL (default) or CSV with ?format=csv,
+#gzipped with ?gzip=1. Streamed in index order so memory use doesn't grow with
+#the number of posts. Only for your own account
+@app.route('/user/<username>/export')
+@login_required
+def export_posts(username):
+    if username != current_user.username:
+        abort(403)
+    format = request.args.get('format', 'jsonl')
+    if format not in MIMETYPES:
+        abort(400)
+    return export_response(post_rows(db.session, current_user.id), POST_FIELDS, format,
+                           '{}-posts'.format(username), compress=request.args.get('gzip', type=int) == 1)
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -119,7 +197,16 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        #Makes cached renderings of this user's posts stale
+        current_user.profile_version = User.profile_version + 1
+        current_user.last_changed = datetime.utcnow()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            form.username.errors.append(_('Please use a different username'))
+            return render_template('edit_profile.html', title="Edit Profile", form=form)
+        explore_cache.invalidate()
         flash('Changes saved')
         return redirect(url_for('edit_profile'))
     #If form.validate is false, request.method checks if browser sent "GET" to get form which
@@ -174,17 +261,62 @@ def unfollow(username):
     else:
         return redirect(url_for('index'))
 
+#Search results, users matching the query on the first page then posts
+#ranked by relevance and recency, paged with cursors
+@app.route('/search')
+@login_required
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for('explore'))
+    query = g.search_form.q.data
+    cursor = request.args.get('cursor')
+    posts, next_cursor = search_posts(query, cursor, app.config['POSTS_PER_PAGE'])
+    users = search_users(query) if not cursor else []
+    if users:
+        #One query for who current_user follows, is_following reads it for each row
+        current_user.followed_ids()
+    next_url = url_for('search', q=query, cursor=next_cursor) if next_cursor else None
+    return render_template('search.html', title=_('Search'), posts=posts, users=users,
+                           next_url=next_url)
+
 #Page to find other users
 @app.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) if posts.has_prev else None
-    return render_template("index.html", title='Explore', posts=posts.items,
+    cached = cached_explore_page()
+    if cached is not None:
+        rows, next_url, prev_url = cached
+        return render_template("index.html", title='Explore', rows=rows,
+                               next_url=next_url, prev_url=prev_url)
+    #selectinload fetches all authors on the page in one query, _post.html uses them for every post
+    posts, next_url, prev_url = paginate_posts(
+        replica(Post.query.options(db.selectinload(Post.author)).order_by(Post.timestamp.desc())), 'explore')
+    return render_template("index.html", title='Explore', posts=posts,
                           next_url=next_url, prev_url=prev_url)
 
+#Pre-rendered rows and links for the requested explore page when the explore
+#cache's snapshot covers it, None otherwise
+def cached_explore_page():
+    snapshot = explore_cache.get()
+    if snapshot is None:
+        return None
+    per_page = app.config['POSTS_PER_PAGE']
+    if app.config['POSTS_PAGINATION'] == 'offset':
+        page = request.args.get('page', 1, type=int)
+        found = snapshot.offset_page(g.locale, page, per_page)
+        if found is None:
+            return None
+        rows, has_next = found
+        next_url = url_for('explore', page=page + 1) if has_next else None
+        prev_url = url_for('explore', page=page - 1) if page > 1 else None
+        return rows, next_url, prev_url
+    found = snapshot.cursor_page(g.locale, request.args.get('cursor'), per_page)
+    if found is None:
+        return None
+    next_url = url_for('explore', cursor=found.next_cursor) if found.has_next else None
+    prev_url = url_for('explore', cursor=found.prev_cursor) if found.has_prev else None
+    return found.items, next_url, prev_url
+
 @app.route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
     if current_user.is_authenticated:
@@ -212,4 +344,45 @@ def reset_password(token):
         db.session.commit()
         flash('Your password has been reset.')
         return redirect(url_for('login'))
-    return render_template('reset_password.html', form=form)
\ No newline at end of file
+    return render_template('reset_password.html', form=form)
+
+#Called from the Translate link in _post.html
+#Translates a post by id (body comes from the database, so the cache entry can't be
+#poisoned by a client) or any text sent with it
+@app.route('/translate', methods=['POST'])
+@login_required
+def translate_text():
+    source_language = request.form.get('source_language')
+    dest_language = request.form.get('dest_language') or g.locale
+    post_id = request.form.get('post_id', type=int)
+    if post_id is not None:
+        post = db.get_or_404(Post, post_id)
+        text = post.body
+        source_language = source_language or post.language
+    else:
+        text = request.form.get('text')
+    if not text or not source_language:
+        return jsonify({'error': _('Nothing to translate')}), 400
+    try:
+        translation = translator.translate(text, source_language, dest_language, post_id)
+    except TranslationError:
+        return jsonify({'error': _('Error: the translation service failed.')}), 502
+    return jsonify({'text': translation})
+
+
+#Per endpoint request, SQL and template timings for Prometheus to scrape,
+#only there when profiling is turned on. Needs PROFILING_METRICS_TOKEN as a
+#bearer token when one is set, otherwise only answers localhost
+def metrics_allowed():
+    token = app.config['PROFILING_METRICS_TOKEN']
+    if not token:
+        return request.remote_addr in ('127.0.0.1', '::1')
+    return hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+
+@app.route('/_metrics')
+def metrics():
+    if not request_profiler.installed:
+        abort(404)
+    if not metrics_allowed():
+        abort(403)
+    return request_profiler.metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
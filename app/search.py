@@ -0,0 +1,325 @@
+import base64
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from sqlalchemy import event, inspect
+from app import app, db
+from app.models import User, Post
+
+#Full-text search over Post.body and User.username/about_me
+#On SQLite the index lives in FTS5 tables next to the data, otherwise in a
+#pure-Python inverted index kept in a local file. Either way it is kept up to
+#date from session events when posts and users are written, and
+#"flask search rebuild" rebuilds it in bulk
+#Posts are ranked by relevance damped by age: score = relevance / (1 + age_days / SEARCH_RECENCY_DAYS)
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+#Cursor for the next page of posts: (score, id) of the last row plus the time the
+#search started, so ages (and so scores) are computed the same way on every page
+def encode_cursor(score, id, now):
+    raw = '{!r}|{}|{}'.format(score, id, now.isoformat())
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        score, id, now = raw.split('|')
+        return float(score), int(id), datetime.fromisoformat(now)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+#SQLite FTS5 tables, rowid is the post/user id
+#Writes go through the flushing session's connection, so they commit or roll back
+#together with the rows they index
+class FTSIndex(object):
+    def index_post(self, session, post):
+        session.connection().execute(db.text('INSERT OR REPLACE INTO post_fts (rowid, body) VALUES (:id, :body)'),
+                                     {'id': post.id, 'body': post.body})
+
+    def index_user(self, session, user):
+        session.connection().execute(db.text('INSERT OR REPLACE INTO user_fts (rowid, username, about_me) '
+                                             'VALUES (:id, :username, :about_me)'),
+                                     {'id': user.id, 'username': user.username, 'about_me': user.about_me})
+
+    def remove(self, session, table, id):
+        session.connection().execute(db.text('DELETE FROM {} WHERE rowid = :id'.format(table)), {'id': id})
+
+    def remove_post(self, session, post):
+        self.remove(session, 'post_fts', post.id)
+
+    def remove_user(self, session, user):
+        self.remove(session, 'user_fts', user.id)
+
+    def commit(self, session):
+        pass
+
+    def rollback(self, session):
+        pass
+
+    #Every term has to match, the last one as a prefix so results show up while typing
+    def match(self, terms):
+        quoted = ['"{}"'.format(term) for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def search_posts(self, terms, now, after, limit):
+        score = ('(-bm25(post_fts) / (1 + (julianday(:now) - julianday(post.timestamp)) / :days))')
+        sql = ('SELECT id, score FROM (SELECT post.id AS id, {} AS score FROM post_fts '
+               'JOIN post ON post.id = post_fts.rowid WHERE post_fts MATCH :match)').format(score)
+        params = {'match': self.match(terms), 'now': now.isoformat(' '),
+                  'days': app.config['SEARCH_RECENCY_DAYS'], 'limit': limit}
+        if after is not None:
+            sql += ' WHERE score < :score OR (score = :score AND id < :id)'
+            params.update(score=after[0], id=after[1])
+        sql += ' ORDER BY score DESC, id DESC LIMIT :limit'
+        return db.session.execute(db.text(sql), params).all()
+
+    def search_users(self, terms, limit):
+        return db.session.scalars(db.text(
+            'SELECT rowid FROM user_fts WHERE user_fts MATCH :match ORDER BY bm25(user_fts) LIMIT :limit'),
+            {'match': self.match(terms), 'limit': limit}).all()
+
+    def rebuild(self):
+        db.session.execute(db.text('DELETE FROM post_fts'))
+        db.session.execute(db.text('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post'))
+        db.session.execute(db.text('DELETE FROM user_fts'))
+        db.session.execute(db.text('INSERT INTO user_fts (rowid, username, about_me) '
+                                   'SELECT id, username, about_me FROM user'))
+        db.session.commit()
+
+#Inverted index in a local SQLite file for databases without FTS5
+#Postings are (term, kind, doc id, term frequency), scoring is BM25 done in Python.
+#Changes are staged on the session during the flush and only written once it commits
+class PythonIndex(object):
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS posting (term TEXT, kind TEXT, doc INTEGER, tf INTEGER, '
+                         'PRIMARY KEY (term, kind, doc)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS doc (kind TEXT, doc INTEGER, length INTEGER, '
+                         'timestamp TEXT, terms TEXT, PRIMARY KEY (kind, doc)) WITHOUT ROWID')
+            self.local.conn = conn
+        return conn
+
+    def index_post(self, session, post):
+        session.info.setdefault('search_changes', []).append(
+            ('post', post.id, tokenize(post.body), post.timestamp))
+
+    def index_user(self, session, user):
+        session.info.setdefault('search_changes', []).append(
+            ('user', user.id, tokenize(user.username) + tokenize(user.about_me), None))
+
+    def remove_post(self, session, post):
+        session.info.setdefault('search_changes', []).append(('post', post.id, None, None))
+
+    def remove_user(self, session, user):
+        session.info.setdefault('search_changes', []).append(('user', user.id, None, None))
+
+    def rollback(self, session):
+        session.info.pop('search_changes', None)
+
+    def commit(self, session):
+        changes = session.info.pop('search_changes', None)
+        if changes:
+            self.write(changes)
+
+    #changes are (kind, doc id, terms or None to remove, timestamp)
+    def write(self, changes):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for kind, doc, terms, timestamp in changes:
+                conn.execute('DELETE FROM posting WHERE term IN (SELECT value FROM json_each('
+                             '(SELECT terms FROM doc WHERE kind = ? AND doc = ?))) AND kind = ? AND doc = ?',
+                             (kind, doc, kind, doc))
+                conn.execute('DELETE FROM doc WHERE kind = ? AND doc = ?', (kind, doc))
+                if terms is None:
+                    continue
+                counts = {}
+                for term in terms:
+                    counts[term] = counts.get(term, 0) + 1
+                conn.executemany('INSERT INTO posting (term, kind, doc, tf) VALUES (?, ?, ?, ?)',
+                                 [(term, kind, doc, tf) for term, tf in counts.items()])
+                conn.execute('INSERT INTO doc (kind, doc, length, timestamp, terms) VALUES (?, ?, ?, ?, ?)',
+                             (kind, doc, len(terms), timestamp.isoformat() if timestamp else None,
+                              json.dumps(list(counts))))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    #BM25 scores of the docs of kind matching every term (last one as a prefix)
+    def scores(self, kind, terms):
+        conn = self.connection()
+        total, length = conn.execute('SELECT count(*), coalesce(sum(length), 0) FROM doc WHERE kind = ?',
+                                     (kind,)).fetchone()
+        if not total:
+            return {}, {}
+        average = length / total
+        scores, matched = {}, None
+        for i, term in enumerate(terms):
+            if i == len(terms) - 1:
+                rows = conn.execute('SELECT posting.doc, tf, length FROM posting JOIN doc ON doc.kind = posting.kind '
+                                    'AND doc.doc = posting.doc WHERE term >= ? AND term < ? AND posting.kind = ?',
+                                    (term, term + '\uffff', kind)).fetchall()
+            else:
+                rows = conn.execute('SELECT posting.doc, tf, length FROM posting JOIN doc ON doc.kind = posting.kind '
+                                    'AND doc.doc = posting.doc WHERE term = ? AND posting.kind = ?',
+                                    (term, kind)).fetchall()
+            docs = {doc for doc, tf, size in rows}
+            idf = math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf, size in rows:
+                scores[doc] = scores.get(doc, 0) + idf * tf * (self.K1 + 1) / (
+                    tf + self.K1 * (1 - self.B + self.B * size / average))
+            matched = docs if matched is None else matched & docs
+        scores = {doc: score for doc, score in scores.items() if doc in matched}
+        timestamps = {}
+        if kind == 'post' and scores:
+            timestamps = dict(conn.execute(
+                'SELECT doc, timestamp FROM doc WHERE kind = ? AND doc IN ({})'.format(','.join('?' * len(scores))),
+                [kind] + list(scores)).fetchall())
+        return scores, timestamps
+
+    def search_posts(self, terms, now, after, limit):
+        scores, timestamps = self.scores('post', terms)
+        ranked = []
+        for doc, score in scores.items():
+            age = (now - datetime.fromisoformat(timestamps[doc])).total_seconds() / 86400 if timestamps.get(doc) else 0
+            ranked.append((score / (1 + age / app.config['SEARCH_RECENCY_DAYS']), doc))
+        ranked.sort(reverse=True)
+        if after is not None:
+            ranked = [(score, doc) for score, doc in ranked if (score, doc) < tuple(after)]
+        return [(doc, score) for score, doc in ranked[:limit]]
+
+    def search_users(self, terms, limit):
+        scores, timestamps = self.scores('user', terms)
+        return sorted(scores, key=lambda doc: (-scores[doc], doc))[:limit]
+
+    def rebuild(self):
+        conn = self.connection()
+        conn.execute('DELETE FROM posting')
+        conn.execute('DELETE FROM doc')
+        for model in [Post, User]:
+            last = 0
+            while True:
+                rows = model.query.filter(model.id > last).order_by(model.id).limit(1000).all()
+                if not rows:
+                    break
+                for row in rows:
+                    if model is Post:
+                        self.index_post(db.session, row)
+                    else:
+                        self.index_user(db.session, row)
+                self.commit(db.session)
+                last = rows[-1].id
+                db.session.expunge_all()
+
+def make_index():
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'auto':
+        backend = 'fts' if db.engine.dialect.name == 'sqlite' else 'python'
+    if backend == 'fts':
+        return FTSIndex()
+    return PythonIndex(app.config['SEARCH_INDEX_PATH'])
+
+search_index = None
+
+def get_index():
+    global search_index
+    if search_index is None:
+        search_index = make_index()
+    return search_index
+
+#Searches posts, returns (posts in rank order, cursor for the next page or None)
+def search_posts(query, cursor=None, per_page=10):
+    terms = tokenize(query)
+    if not terms:
+        return [], None
+    decoded = decode_cursor(cursor) if cursor else None
+    now = decoded[2] if decoded else datetime.utcnow()
+    after = decoded[:2] if decoded else None
+    rows = get_index().search_posts(terms, now, after, per_page + 1)
+    posts = {post.id: post for post in Post.query.options(db.selectinload(Post.author)).filter(
+        Post.id.in_([id for id, score in rows[:per_page]]))}
+    results = [posts[id] for id, score in rows[:per_page] if id in posts]
+    next_cursor = None
+    if len(rows) > per_page:
+        id, score = rows[per_page - 1]
+        next_cursor = encode_cursor(score, id, now)
+    return results, next_cursor
+
+def search_users(query, limit=5):
+    terms = tokenize(query)
+    if not terms:
+        return []
+    ids = get_index().search_users(terms, limit)
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+    return [users[id] for id in ids if id in users]
+
+#Keeps the index in step with the session: new and changed posts/users are
+#(re)indexed during the flush, deleted ones are removed
+def changed(obj, *fields):
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+@event.listens_for(db.session, 'after_flush')
+def index_flushed(session, flush_context):
+    index = get_index()
+    for obj in session.new:
+        if isinstance(obj, Post):
+            index.index_post(session, obj)
+        elif isinstance(obj, User):
+            index.index_user(session, obj)
+    for obj in session.dirty:
+        if isinstance(obj, Post) and changed(obj, 'body'):
+            index.index_post(session, obj)
+        elif isinstance(obj, User) and changed(obj, 'username', 'about_me'):
+            index.index_user(session, obj)
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            index.remove_post(session, obj)
+        elif isinstance(obj, User):
+            index.remove_user(session, obj)
+
+@event.listens_for(db.session, 'after_commit')
+def index_committed(session):
+    if search_index is not None:
+        search_index.commit(session)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def index_rolled_back(session, previous_transaction):
+    if search_index is not None:
+        search_index.rollback(session)
+
+#FTS5 tables are created and dropped along with the rest of the schema on SQLite
+SEARCH_TABLES = ('post_fts', 'user_fts')
+
+for ddl in ['CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)',
+            'CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username, about_me)']:
+    event.listen(db.metadata, 'after_create', db.DDL(ddl).execute_if(dialect='sqlite'))
+for table in SEARCH_TABLES:
+    event.listen(db.metadata, 'before_drop', db.DDL('DROP TABLE IF EXISTS ' + table).execute_if(dialect='sqlite'))
+
+#include_object hook for Alembic (migrations/env.py): the FTS5 tables and their
+#shadow tables (post_fts_data, post_fts_idx...) aren't in db.metadata, without
+#this "flask db migrate" would generate drop_table for all of them
+def include_in_migrations(object, name, type_, reflected, compare_to):
+    return not (type_ == 'table' and name.startswith(SEARCH_TABLES))
@@ -1,25 +1,155 @@
-# import json
-# import requests
-# from flask_babel import _
-# from app import app
-
-
-# #Currently not set up since I don't want to give my card to Microsoft
-# #and the translate free trial only lasts 12 months
-
-# def translate(text, source_language, dest_language):
-#     #Still coding as if it did work: checks if key is saved
-#     if 'MS_TRANSLATOR_KEY' not in app.config or not app.config['MS_TRANSLATOR_KEY']:
-#         return _('ERROR: translation service not configured')
-#     #gets key to be passed as auth header for validation
-#     auth = {
-#         'Ocp-Apim-Subscription-Key': app.config['MS_TRANSLATOR_KEY'],
-#         'Ocp-Apim-Subscription-Region': 'westus2'}
-#     #Sends request to API
-#     r = requests.post(
-#         'https://api.cognitive.microsofttranslator.com'
-#         '/translate?api-version=3.0&from={}&to={}'.format(
-#             source_language, dest_language), headers=auth, json=[{'Text': text}])
-#     if r.status_code != 200:
-#         return _('Error: the translation service failed.')
-#     return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+import json
+import threading
+import time
+from concurrent.futures import Future
+from hashlib import md5
+from urllib.request import Request, urlopen
+from app import app
+from app.cache import make_cache
+
+#Translation backends take a batch of texts with the same source and destination
+#language and return the translations in the same order
+
+#Microsoft Translator, the API accepts several texts in one request
+class MicrosoftTranslator(object):
+    URL = 'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0&from={}&to={}'
+
+    def __init__(self, key, region='westus2', timeout=10):
+        self.key = key
+        self.region = region
+        self.timeout = timeout
+
+    def translate(self, texts, source_language, dest_language):
+        #gets key to be passed as auth header for validation
+        headers = {
+            'Ocp-Apim-Subscription-Key': self.key,
+            'Ocp-Apim-Subscription-Region': self.region,
+            'Content-Type': 'application/json'}
+        request = Request(self.URL.format(source_language, dest_language), method='POST', headers=headers,
+                          data=json.dumps([{'Text': text} for text in texts]).encode('utf-8'))
+        with urlopen(request, timeout=self.timeout) as response:
+            results = json.loads(response.read().decode('utf-8'))
+        return [result['translations'][0]['text'] for result in results]
+
+#Offline stand-in so the feature works (and can be tested) without an API key,
+#tags the text with the language pair instead of translating it
+class LocalTranslator(object):
+    def translate(self, texts, source_language, dest_language):
+        return ['[{}>{}] {}'.format(source_language, dest_language, text) for text in texts]
+
+class TranslationError(Exception):
+    pass
+
+#Front of the backends: answers from a persistent cache keyed by
+#(post id or body hash, source, dest), and when it has to go to the backend
+#collects requests for TRANSLATION_BATCH_WINDOW seconds so they go out as one
+#call per language pair. Identical requests made while one is in flight wait
+#on the same result instead of being translated again
+class Translator(object):
+    def __init__(self, backend, cache=None, ttl=None, window=0.05, timeout=15):
+        self.backend = backend
+        self.cache = cache
+        self.ttl = ttl
+        self.window = window
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.pending = []
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def key(text, source_language, dest_language, post_id=None):
+        ref = 'post{}'.format(post_id) if post_id is not None else md5(text.encode('utf-8')).hexdigest()
+        return 'translation:{}:{}:{}'.format(ref, source_language, dest_language)
+
+    def translate(self, text, source_language, dest_language, post_id=None):
+        key = self.key(text, source_language, dest_language, post_id)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+                self.pending.append((key, text, source_language, dest_language, future))
+        if owner:
+            if self.window:
+                self.start()
+                self.wakeup.set()
+            else:
+                self.flush()
+        try:
+            return future.result(self.timeout)
+        except Exception as e:
+            raise TranslationError(e)
+
+    #Sends everything pending to the backend, one call per language pair
+    #Every future gets a result or an exception and leaves in_flight whatever
+    #happens, so no request is left waiting on a translation that won't come
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        try:
+            groups = {}
+            for item in pending:
+                groups.setdefault((item[2], item[3]), []).append(item)
+            for (source_language, dest_language), items in groups.items():
+                try:
+                    results = self.backend.translate([item[1] for item in items], source_language, dest_language)
+                    if len(results) != len(items):
+                        raise TranslationError('Expected {} translations, got {}'.format(len(items), len(results)))
+                except Exception as e:
+                    app.logger.warning('Translation of %d texts failed: %r', len(items), e)
+                    results = [e] * len(items)
+                for (key, text, source, dest, future), result in zip(items, results):
+                    with self.lock:
+                        self.in_flight.pop(key, None)
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                        continue
+                    if self.cache is not None:
+                        try:
+                            self.cache.set(key, result, self.ttl)
+                        except Exception as e:
+                            app.logger.warning('Could not cache a translation: %r', e)
+                    future.set_result(result)
+        finally:
+            for key, text, source, dest, future in pending:
+                with self.lock:
+                    self.in_flight.pop(key, None)
+                if not future.done():
+                    future.set_exception(TranslationError('Translation was not sent'))
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            #Let requests from other users pile up for a moment
+            time.sleep(self.window)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Translation batch failed')
+
+def make_backend(name):
+    if name == 'microsoft':
+        return MicrosoftTranslator(app.config['MS_TRANSLATOR_KEY'], app.config['MS_TRANSLATOR_REGION'])
+    return LocalTranslator()
+
+translator = Translator(
+    make_backend(app.config['TRANSLATOR']),
+    make_cache(app.config['TRANSLATION_CACHE'], app.config['TRANSLATION_CACHE_MAX_BYTES'],
+               app.config['TRANSLATION_CACHE_PATH']),
+    app.config['TRANSLATION_CACHE_TTL'], app.config['TRANSLATION_BATCH_WINDOW'])
@@ -0,0 +1,131 @@
+import math
+import threading
+from hashlib import blake2b
+from sqlalchemy import event, inspect
+from app import app, db
+from app.models import User
+
+#Fixed size Bloom filter: no false negatives, about error_rate false positives
+#once capacity items are in. Bit positions come from one blake2b digest split
+#in two (double hashing), so an add or lookup is a single hash
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        digest = blake2b(value.encode('utf-8'), digest_size=16).digest()
+        a, b = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+#Answers "is this username/email taken" for the registration and profile forms
+#Values the filter has never seen are free without a query, possible hits are
+#checked against the column's unique index. A background thread, started by the
+#first check, builds the filters from the user table and rebuilds them every
+#UNIQUENESS_REBUILD_INTERVAL seconds (or as soon as they fill up) to pick up users
+#added by other processes or outside the ORM, swapping the new ones in under the
+#lock. Requests only read them, until the first build is done every check goes to
+#the index. New values are added as sessions commit. A value missed in between can
+#still pass the form, so the unique constraints stay the final check (see
+#register/edit_profile). An interval of 0 turns the thread off, filters then only
+#come from build()
+class UniquenessChecker(object):
+    FIELDS = ('username', 'email')
+
+    def __init__(self, capacity=100000, error_rate=0.01, rebuild_interval=600):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.filters = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    #In an app context of its own so it works from the thread
+    def build(self):
+        with app.app_context():
+            count = db.session.scalar(db.select(db.func.count(User.id)))
+            capacity = max(self.capacity, count * 2)
+            filters = {field: BloomFilter(capacity, self.error_rate) for field in self.FIELDS}
+            rows = db.session.execute(db.select(User.username, User.email).execution_options(yield_per=1000))
+            for username, email in rows:
+                if username:
+                    filters['username'].add(username)
+                if email:
+                    filters['email'].add(email)
+        with self.lock:
+            self.filters = filters
+
+    def full(self, filters):
+        return any(f.count > f.capacity for f in filters.values())
+
+    def taken(self, field, value):
+        self.start()
+        filters = self.filters
+        if filters is None:
+            return self.exists(field, value)
+        if self.full(filters):
+            self.wakeup.set()
+        if value not in filters[field]:
+            return False
+        return self.exists(field, value)
+
+    #Straight to the index, skipping the filter
+    def exists(self, field, value):
+        return db.session.scalar(db.select(db.exists().where(getattr(User, field) == value)))
+
+    def add(self, field, value):
+        filters = self.filters
+        if filters is not None and value:
+            with self.lock:
+                filters[field].add(value)
+
+    def start(self):
+        if not self.rebuild_interval or self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                self.build()
+            except Exception:
+                app.logger.exception('Uniqueness filter build failed')
+            self.wakeup.wait(self.rebuild_interval)
+
+uniqueness = UniquenessChecker(app.config['UNIQUENESS_CAPACITY'], app.config['UNIQUENESS_ERROR_RATE'],
+                               app.config['UNIQUENESS_REBUILD_INTERVAL'])
+
+#New and changed usernames/emails are collected during the flush and added
+#to the filters once the transaction commits
+@event.listens_for(db.session, 'after_flush')
+def collect_names(session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, User):
+            values = inspect(obj).dict
+            session.info.setdefault('unique_values', []).extend(
+                (field, values.get(field)) for field in UniquenessChecker.FIELDS)
+
+@event.listens_for(db.session, 'after_commit')
+def add_names(session):
+    for field, value in session.info.pop('unique_values', ()):
+        uniqueness.add(field, value)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_names(session, previous_transaction):
+    session.info.pop('unique_values', None)
@@ -5,6 +5,22 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'nope'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool, not used for in-memory SQLite which has one shared connection
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 3600)
+    SQLALCHEMY_ENGINE_OPTIONS = {} if SQLALCHEMY_DATABASE_URI in ('sqlite://', 'sqlite:///:memory:') else {
+        'pool_size': DATABASE_POOL_SIZE, 'max_overflow': DATABASE_MAX_OVERFLOW,
+        'pool_recycle': DATABASE_POOL_RECYCLE, 'pool_pre_ping': True}
+    # Pragmas for every SQLite connection (see app/database.py), busy timeout in ms
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'wal'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'normal'
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    # Optional engine for explore and feed reads, a replica or for SQLite the same file
+    # read only: sqlite:///file:/path/to/app.db?mode=ro&uri=true
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+    SQLALCHEMY_BINDS = {'read': DATABASE_READ_URL} if DATABASE_READ_URL else {}
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -12,10 +28,122 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # Queued mail is sent up to MAIL_BATCH_SIZE messages at a time over one SMTP connection
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    # Deferred work (mail, language detection, last_seen writes) is queued in a local SQLite
+    # file. Web processes run JOB_WORKERS threads for it unless JOB_EXTERNAL_WORKER is set,
+    # then only "flask worker" runs jobs, on threads or processes (JOB_POOL). Failed jobs are
+    # retried with exponential backoff (JOB_BACKOFF seconds) JOB_MAX_ATTEMPTS times
+    JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH') or os.path.join(basedir, 'queue', 'jobs.db')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
+    JOB_POOL = os.environ.get('JOB_POOL') or 'thread'
+    JOB_EXTERNAL_WORKER = os.environ.get('JOB_EXTERNAL_WORKER') is not None
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 5)
+    JOB_BACKOFF = int(os.environ.get('JOB_BACKOFF') or 30)
+    JOB_POLL = float(os.environ.get('JOB_POLL') or 1)
+
+    # Password hashes use PASSWORD_HASH_METHOD (any werkzeug method, e.g. pbkdf2:sha256:600000),
+    # older hashes are redone on the next successful login. Hashing runs on
+    # PASSWORD_HASH_WORKERS threads with at most PASSWORD_HASH_QUEUE calls waiting
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    # Failed logins allowed per username and per client address in a sliding window of
+    # LOGIN_ATTEMPTS_WINDOW seconds, counted in 'memory' (per worker) or 'sqlite' (shared file)
+    LOGIN_ATTEMPTS_PER_USER = int(os.environ.get('LOGIN_ATTEMPTS_PER_USER') or 5)
+    LOGIN_ATTEMPTS_PER_IP = int(os.environ.get('LOGIN_ATTEMPTS_PER_IP') or 50)
+    LOGIN_ATTEMPTS_WINDOW = int(os.environ.get('LOGIN_ATTEMPTS_WINDOW') or 300)
+    LOGIN_LIMITER = os.environ.get('LOGIN_LIMITER') or 'memory'
+    LOGIN_LIMITER_PATH = os.environ.get('LOGIN_LIMITER_PATH') or os.path.join(basedir, 'cache', 'logins.db')
+
+    # Most usernames one POST /api/follow can follow
+    FOLLOW_IMPORT_LIMIT = int(os.environ.get('FOLLOW_IMPORT_LIMIT') or 10000)
 
     POSTS_PER_PAGE = 10
+    # 'cursor' pages feeds by (timestamp, id), 'offset' uses the old ?page=N links
+    POSTS_PAGINATION = os.environ.get('POSTS_PAGINATION') or 'cursor'
+
+    # Precomputed home timelines, new posts get pushed to followers on write
+    # run "flask timeline rebuild" after turning this on for an existing database
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT') is not None
+
+    # last_seen is only written when it moves by more than this many seconds,
+    # buffered timestamps are written in bulk every LAST_SEEN_FLUSH_INTERVAL seconds
+    # (0 turns off the background writer, leaving only the write at shutdown)
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+
+    # Bloom filters of usernames/emails sized for UNIQUENESS_CAPACITY users at
+    # UNIQUENESS_ERROR_RATE false positives, rebuilt from the database by a background
+    # thread every UNIQUENESS_REBUILD_INTERVAL seconds (0 turns the thread off)
+    UNIQUENESS_CAPACITY = int(os.environ.get('UNIQUENESS_CAPACITY') or 100000)
+    UNIQUENESS_ERROR_RATE = float(os.environ.get('UNIQUENESS_ERROR_RATE') or 0.01)
+    UNIQUENESS_REBUILD_INTERVAL = int(os.environ.get('UNIQUENESS_REBUILD_INTERVAL') or 600)
+
+    # Users loaded for logged in requests are cached for USER_CACHE_TTL seconds,
+    # 'memory' (per worker), 'sqlite' (file shared by workers) or 'none'
+    USER_CACHE = os.environ.get('USER_CACHE') or 'memory'
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)
+    USER_CACHE_MAX_BYTES = int(os.environ.get('USER_CACHE_MAX_BYTES') or 4 * 1024 * 1024)
+    USER_CACHE_PATH = os.environ.get('USER_CACHE_PATH') or os.path.join(basedir, 'cache', 'users.db')
+
+    # Rendered post rows, 'memory' (per worker), 'sqlite' (file shared by workers) or 'none'
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE') or 'memory'
+    FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES') or 16 * 1024 * 1024)
+    FRAGMENT_CACHE_PATH = os.environ.get('FRAGMENT_CACHE_PATH') or os.path.join(basedir, 'cache', 'fragments.db')
+
+    # The first EXPLORE_CACHE_PAGES pages of /explore are served from a shared snapshot,
+    # rebuilt in the background every EXPLORE_CACHE_INTERVAL seconds and after new posts
+    # (0 turns the background refresh off), 0 pages turns the cache off. Refreshes start
+    # at least EXPLORE_CACHE_MIN_INTERVAL seconds apart, new posts in between share one
+    EXPLORE_CACHE_PAGES = int(os.environ.get('EXPLORE_CACHE_PAGES') or 5)
+    EXPLORE_CACHE_INTERVAL = float(os.environ.get('EXPLORE_CACHE_INTERVAL') or 30)
+    EXPLORE_CACHE_MIN_INTERVAL = float(os.environ.get('EXPLORE_CACHE_MIN_INTERVAL') or 2)
+
+    # Text responses of RESPONSE_COMPRESS_MIN_BYTES or more are sent compressed: 'auto' uses
+    # brotli when it is installed and the client takes it, else gzip; 'gzip' or 'none'
+    RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION') or 'auto'
+    RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES') or 1024)
+    RESPONSE_GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL') or 6)
+    RESPONSE_BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY') or 5)
+    # Logged out login/register/password reset pages, cached per locale for PAGE_CACHE_TTL
+    # seconds, 'memory' (per worker), 'sqlite' (file shared by workers) or 'none'
+    PAGE_CACHE = os.environ.get('PAGE_CACHE') or 'memory'
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL') or 300)
+    PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES') or 1024 * 1024)
+    PAGE_CACHE_PATH = os.environ.get('PAGE_CACHE_PATH') or os.path.join(basedir, 'cache', 'pages.db')
+
+    # Post languages are detected by job workers, up to LANGUAGE_DETECT_BATCH_SIZE posts at a time
+    LANGUAGE_DETECT_BATCH_SIZE = int(os.environ.get('LANGUAGE_DETECT_BATCH_SIZE') or 32)
+
+    # Full-text search, 'auto' uses FTS5 on SQLite and the Python index file otherwise,
+    # a post's relevance is halved once it is SEARCH_RECENCY_DAYS old
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or os.path.join(basedir, 'cache', 'search.db')
+    SEARCH_RECENCY_DAYS = float(os.environ.get('SEARCH_RECENCY_DAYS') or 30)
+
+    # Per request SQL and template timing, off unless PROFILING is set. Adds Server-Timing
+    # headers, serves /_metrics and logs each request, with its PROFILING_TOP_QUERIES
+    # slowest statements when it took longer than PROFILING_SLOW_MS
+    PROFILING = os.environ.get('PROFILING') is not None
+    PROFILING_TOP_QUERIES = int(os.environ.get('PROFILING_TOP_QUERIES') or 5)
+    PROFILING_SLOW_MS = float(os.environ.get('PROFILING_SLOW_MS') or 500)
+    # Scrapers send it as "Authorization: Bearer <token>", without one /_metrics only
+    # answers requests from localhost
+    PROFILING_METRICS_TOKEN = os.environ.get('PROFILING_METRICS_TOKEN')
 
     LANGUAGES = ['en', 'es']
 
     # Currently does not exist, as I don't want to give Microsoft my card
-    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
\ No newline at end of file
+    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION') or 'westus2'
+    # 'microsoft' or 'local' (offline stand-in), defaults to microsoft when there is a key
+    TRANSLATOR = os.environ.get('TRANSLATOR') or ('microsoft' if MS_TRANSLATOR_KEY else 'local')
+    # Translations are cached for TRANSLATION_CACHE_TTL seconds, requests within
+    # TRANSLATION_BATCH_WINDOW seconds of each other go to the backend together
+    TRANSLATION_CACHE = os.environ.get('TRANSLATION_CACHE') or 'sqlite'
+    TRANSLATION_CACHE_PATH = os.environ.get('TRANSLATION_CACHE_PATH') or os.path.join(basedir, 'cache', 'translations.db')
+    TRANSLATION_CACHE_MAX_BYTES = int(os.environ.get('TRANSLATION_CACHE_MAX_BYTES') or 64 * 1024 * 1024)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 30 * 24 * 3600)
+    TRANSLATION_BATCH_WINDOW = float(os.environ.get('TRANSLATION_BATCH_WINDOW') or 0.05)
\ No newline at end of file
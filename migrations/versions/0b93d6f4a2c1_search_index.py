@@ -0,0 +1,34 @@
+"""search index
+
+Revision ID: 0b93d6f4a2c1
+Revises: f1b6e08a3d52
+Create Date: 2026-10-18 14:02:46.751203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b93d6f4a2c1'
+down_revision = 'f1b6e08a3d52'
+branch_labels = None
+depends_on = None
+
+
+# FTS5 tables only exist on SQLite, other databases use the index file
+# ("flask search rebuild" fills that one)
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+    op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username, about_me)')
+    op.execute('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')
+    op.execute('INSERT INTO user_fts (rowid, username, about_me) SELECT id, username, about_me FROM user')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE IF EXISTS user_fts')
+    op.execute('DROP TABLE IF EXISTS post_fts')
@@ -17,16 +17,14 @@ depends_on = None
 
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
+    # bb8f1371e5f6 already adds post.language, only add it where that didn't happen
+    columns = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('post')]
+    if 'language' in columns:
+        return
     with op.batch_alter_table('post', schema=None) as batch_op:
         batch_op.add_column(sa.Column('language', sa.String(length=5), nullable=True))
 
-    # ### end Alembic commands ###
-
 
 def downgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    with op.batch_alter_table('post', schema=None) as batch_op:
-        batch_op.drop_column('language')
-
-    # ### end Alembic commands ###
+    # the column is dropped by bb8f1371e5f6's downgrade
+    pass
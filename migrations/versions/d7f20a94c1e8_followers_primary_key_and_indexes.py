@@ -0,0 +1,68 @@
+"""followers primary key and indexes
+
+Revision ID: d7f20a94c1e8
+Revises: c83e5b1f60a7
+Create Date: 2026-10-18 11:26:51.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f20a94c1e8'
+down_revision = 'c83e5b1f60a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # followers gets rebuilt so duplicate edges can be dropped before the
+    # primary key goes on
+    op.rename_table('followers', '_followers_old')
+    op.create_table('followers',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO followers (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM _followers_old '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('_followers_old')
+
+    # the counters were backfilled from followers while it still had duplicate
+    # edges, count again now that each edge is there once
+    user = sa.table('user', sa.column('id'), sa.column('followers_count'), sa.column('followed_count'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    op.execute(user.update().values(
+        followers_count=sa.select(sa.func.count()).where(
+            followers.c.followed_id == user.c.id).scalar_subquery(),
+        followed_count=sa.select(sa.func.count()).where(
+            followers.c.follower_id == user.c.id).scalar_subquery()))
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_user_id_timestamp')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+
+    op.rename_table('followers', '_followers_old')
+    op.create_table('followers',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers (follower_id, followed_id) '
+               'SELECT follower_id, followed_id FROM _followers_old')
+    op.drop_table('_followers_old')
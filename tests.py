@@ -1,9 +1,46 @@
 import os
+import tempfile
 os.environ['DATABASE_URL'] = 'sqlite://' #use own database without touching the already created one
+os.environ['LAST_SEEN_FLUSH_INTERVAL'] = '0' #no background last_seen writer, tests flush by hand
+os.environ['JOB_EXTERNAL_WORKER'] = '1' #no job worker threads, tests drain their own queues
+os.environ['JOB_QUEUE_PATH'] = os.path.join(tempfile.gettempdir(), 'microblog-test-jobs.db')
+os.environ['TRANSLATION_CACHE'] = 'memory'
+os.environ['TRANSLATION_BATCH_WINDOW'] = '0' #translate in the calling thread
+os.environ['FRAGMENT_CACHE'] = 'none' #post ids get reused between tests, caching tests set up their own
+os.environ['USER_CACHE'] = 'none' #same for user ids
+os.environ['PAGE_CACHE'] = 'none' #tests switch CSRF on and off, the cache test sets up its own
+os.environ['EXPLORE_CACHE_INTERVAL'] = '0' #no background explore refresh, tests refresh by hand
+os.environ['UNIQUENESS_REBUILD_INTERVAL'] = '0' #no background filter builds, tests build by hand
 from datetime import datetime, timedelta
 import unittest
-from app import app, db
-from app.models import User, Post
+import random
+import time
+import socketserver
+import threading
+import re
+import gzip
+import json
+import sqlalchemy
+import flask_migrate
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask import template_rendered
+from app import app, db, fragments, cli
+from app.models import User, Post, followers, user_cache
+from hashlib import md5
+from app.pagination import paginate_cursor
+from app.last_seen import LastSeenTracker
+from app.profiling import QueryCounter, request_profiler
+from app.cache import MemoryCache, SQLiteCache
+from app.jobs import JobQueue, task
+from app.language import language_detector
+from app.translate import Translator, LocalTranslator, TranslationError, translator
+from app import search, bench, responses, models
+from app.uniqueness import BloomFilter, UniquenessChecker, uniqueness
+from app.explore_cache import ExploreCache, explore_cache
+from app.forms import RegistrationForm
+from app.database import tune_sqlite, sqlite_pragmas
+from app.passwords import PasswordHasher, HashingBusy, MemoryLimiter, SQLiteLimiter, password_hasher, login_limiter
 
 #Unit tests for testing User model
 class UserModelCase(unittest.TestCase):
@@ -26,6 +63,15 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    #Testing avatar URLs, the stored digest follows email changes
+    def test_avatar(self):
+        u = User(username='john', email='john@example.com')
+        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
+                                         'd4c74594d841139328695756648b6bd6'
+                                         '?d=identicon&s=128'))
+        u.email = 'John@Example.com'
+        self.assertEqual(u.email_hash, 'd4c74594d841139328695756648b6bd6')
+
     #Testing following
     def test_follow(self):
         u1 = User(username='user1', email='user1@example.com')
@@ -84,5 +130,1421 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    #Same setup as above but with timelines precomputed on write
+    def test_timeline_fanout(self):
+        app.config['TIMELINE_FANOUT'] = True
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_FANOUT', False)
+        u1 = User(username='user1', email='user1@example.com')
+        u2 = User(username='user2', email='user2@example.com')
+        u3 = User(username='user3', email='user3@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body='post from user1', author=u1, timestamp=now+timedelta(seconds=1))
+        p2 = Post(body='post from user2', author=u2, timestamp=now+timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        p1.fan_out()
+        p2.fan_out()
+        db.session.commit()
+
+        #Following backfills, new posts get pushed to followers
+        u1.follow(u2)
+        u3.follow(u1)
+        db.session.commit()
+        p3 = Post(body='post from user1', author=u1, timestamp=now+timedelta(seconds=3))
+        db.session.add(p3)
+        p3.fan_out()
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+        self.assertEqual(u3.followed_posts().all(), [p3, p1])
+        for u in [u1, u2, u3]:
+            self.assertEqual(u.followed_posts().all(), u.computed_followed_posts().all())
+            self.assertEqual(u.timeline_drift(), (set(), set()))
+
+        #Unfollowing prunes
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p1])
+        self.assertEqual(u1.timeline_drift(), (set(), set()))
+
+    #Once followed_ids() is loaded, is_following needs no queries and stays in sync
+    def test_followed_ids_memo(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        u1 = users[0]
+        u1.follow(users[1])
+        db.session.commit()
+        self.assertTrue(u1.is_following(users[1]))
+        self.assertEqual(list(u1.followed_ids()), [users[1].id])
+        for u in users:
+            db.session.refresh(u)
+        with QueryCounter() as queries:
+            self.assertEqual([u1.is_following(u) for u in users], [False, True, False, False, False])
+        self.assertEqual(queries.count, 0)
+
+        u1.follow(users[3])
+        u1.unfollow(users[1])
+        db.session.commit()
+        self.assertEqual(list(u1.followed_ids()), [users[3].id])
+        self.assertEqual([u.id for u in u1.followed], [users[3].id])
+
+    #Counters follow follow/unfollow and new posts, repair_counts fixes drift
+    def test_counters(self):
+        u1 = User(username='user1', email='user1@example.com')
+        u2 = User(username='user2', email='user2@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u2)
+        db.session.add_all([Post(body='one', author=u2), Post(body='two', author=u2)])
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.followers_count, u1.posts_count), (1, 0, 0))
+        self.assertEqual((u2.followed_count, u2.followers_count, u2.posts_count), (0, 1, 2))
+        u1.unfollow(u2)
+        db.session.delete(u2.posts.first())
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.followers_count, u2.posts_count), (0, 0, 1))
+
+        self.assertEqual(User.repair_counts(), 0)
+        u1.followers_count = 7
+        u2.posts_count = 0
+        db.session.commit()
+        self.assertEqual(User.repair_counts(), 2)
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u2.posts_count), (0, 1))
+
+    #Languages are filled in from the queue, identical bodies hit the memo
+    def test_language_detection(self):
+        u = User(username='user1', email='user1@example.com')
+        bodies = ['This is a post written in plain English for everyone',
+                  'Esta es una publicación escrita en español para todos',
+                  'This is a post written in plain English for everyone']
+        posts = [Post(body=body, author=u) for body in bodies]
+        db.session.add_all(posts)
+        db.session.commit()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        queue = JobQueue(os.path.join(directory.name, 'jobs.db'), external=True)
+        language_detector.memo.clear()
+        for post in posts:
+            queue.enqueue('detect_language', post.id, post.body)
+        self.assertIsNone(posts[0].language)
+        self.assertEqual(queue.drain(), 3)
+        db.session.expire_all()
+        self.assertEqual([p.language for p in posts], ['en', 'es', 'en'])
+        self.assertEqual(len(language_detector.memo.items), 2)
+        self.assertEqual([row[:3] for row in queue.stats()], [('detect_language', 3, 0)])
+
+        #The CLI backfill only picks up posts without a language
+        post = Post(body='Une autre publication écrite en français pour tout le monde', author=u)
+        db.session.add(post)
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['language', 'backfill'])
+        self.assertIn('1 post(s) processed', result.output)
+        db.session.expire_all()
+        self.assertEqual(post.language, 'fr')
+
+    #Walks feeds forwards and back with cursors, including posts with identical timestamps
+    def test_cursor_pagination(self):
+        u1 = User(username='user1', email='user1@example.com')
+        u2 = User(username='user2', email='user2@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=[u1, u2][i % 2],
+                      timestamp=now+timedelta(seconds=i // 3)) for i in range(11)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+        for fanout in [False, True]:
+            app.config['TIMELINE_FANOUT'] = fanout
+            if fanout:
+                u1.rebuild_timeline()
+                db.session.commit()
+            pages, cursor = [], None
+            while True:
+                page = paginate_cursor(u1.followed_posts(), cursor, 4, u1.followed_posts_keys())
+                pages.append(page.items)
+                if not page.has_next:
+                    break
+                cursor = page.next_cursor
+            self.assertEqual([len(p) for p in pages], [4, 4, 3])
+            self.assertEqual(sum(pages, []), expected)
+            #Going back from the last page lands on the middle one
+            back = paginate_cursor(u1.followed_posts(), page.prev_cursor, 4, u1.followed_posts_keys())
+            self.assertEqual(back.items, pages[1])
+            self.assertTrue(back.has_next and back.has_prev)
+        app.config['TIMELINE_FANOUT'] = False
+
+        self.assertEqual(paginate_cursor(Post.query, 'garbage', 4).items, expected[:4])
+
+    #last_seen is buffered and only written when it moves past the granularity
+    def test_last_seen_tracker(self):
+        u1 = User(username='user1', email='user1@example.com')
+        u2 = User(username='user2', email='user2@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        start = u1.last_seen
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        queue = JobQueue(os.path.join(directory.name, 'jobs.db'), external=True)
+        tracker = LastSeenTracker(queue)
+
+        #Within the granularity nothing is buffered
+        tracker.touch(u1, start + timedelta(seconds=30))
+        self.assertEqual(tracker.pending, {})
+        tracker.touch(u1, start + timedelta(seconds=90))
+        tracker.touch(u1, start + timedelta(seconds=100))
+        tracker.touch(u2, start + timedelta(seconds=120))
+        self.assertEqual(tracker.pending, {u1.id: start + timedelta(seconds=90),
+                                           u2.id: start + timedelta(seconds=120)})
+        self.assertEqual(tracker.last_seen(u1), start + timedelta(seconds=90))
+
+        self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(tracker.pending, {})
+        #Written by the job worker
+        self.assertEqual(queue.drain(), 1)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, start + timedelta(seconds=90))
+        self.assertEqual(u2.last_seen, start + timedelta(seconds=120))
+        self.assertEqual(tracker.flush(), 0)
+
+#Base for tests that go through the routes with the test client
+class RouteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+
+class FeedRenderCase(RouteTestCase):
+    #Creates a reader following `authors` users who have one post each,
+    #returns the number of statements it takes to render each feed page
+    def feed_queries(self, authors):
+        reader = User(username='reader', email='reader@example.com')
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(authors)]
+        db.session.add_all([reader] + users)
+        db.session.commit()
+        for u in users:
+            reader.follow(u)
+            db.session.add(Post(body='post from {}'.format(u.username), author=u))
+        db.session.commit()
+        self.login(reader)
+        #Start from an empty identity map like a real request would
+        db.session.expunge_all()
+        counts = {}
+        for url in ['/index', '/explore', '/user/user0']:
+            with QueryCounter() as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            counts[url] = queries.count
+        #Fresh app context so the next run doesn't see this one's logged in user
+        self.tearDown()
+        self.setUp()
+        return counts
+
+    #Authors are loaded in bulk so the number of statements doesn't grow with them
+    def test_feed_query_count_constant(self):
+        self.assertEqual(self.feed_queries(2), self.feed_queries(8))
+
+    #Post rows come from the fragment cache until the author edits their profile
+    def test_post_fragment_cache(self):
+        fragments.fragment_cache = MemoryCache(1024 * 1024)
+        self.addCleanup(setattr, fragments, 'fragment_cache', None)
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+        u1 = User(username='user1', email='user1@example.com')
+        u2 = User(username='user2', email='user2@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='post from user1', author=u1), Post(body='post from user2', author=u2)])
+        db.session.commit()
+        self.login(u1)
+
+        rendered = []
+        def record(sender, template, context, **extra):
+            if template.name == '_post.html':
+                rendered.append(context['post'].body)
+        template_rendered.connect(record, app)
+        self.addCleanup(template_rendered.disconnect, record, app)
+
+        self.assertIn(b'post from user2', self.client.get('/explore').data)
+        self.assertEqual(len(rendered), 2)
+        self.client.get('/explore')
+        self.assertEqual(len(rendered), 2)
+
+        #Editing user1's profile only re-renders user1's post
+        self.client.post('/edit_profile', data={'username': 'renamed', 'about_me': ''})
+        data = self.client.get('/explore').data
+        self.assertEqual(rendered[2:], ['post from user1'])
+        self.assertIn(b'renamed', data)
+
+    #Both cache backends evict least recently used entries past the cap
+    def test_cache_backends(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_cache.db')
+        self.addCleanup(lambda: [os.remove(path + suffix) for suffix in ['', '-wal', '-shm']
+                                 if os.path.exists(path + suffix)])
+        sqlite_cache = SQLiteCache(path, 1000)
+        sqlite_cache.EVICT_EVERY = 1
+        #Hits within TOUCH_INTERVAL of the last write don't update atime
+        sqlite_cache.set('hot', 'x')
+        atime = sqlite_cache.connection().execute("SELECT atime FROM cache WHERE key = 'hot'").fetchone()[0]
+        time.sleep(0.01)
+        self.assertEqual(sqlite_cache.get('hot'), 'x')
+        self.assertEqual(sqlite_cache.connection().execute("SELECT atime FROM cache WHERE key = 'hot'").fetchone()[0],
+                         atime)
+        sqlite_cache.delete('hot')
+        sqlite_cache.TOUCH_INTERVAL = 0
+        for cache in [MemoryCache(1000), sqlite_cache]:
+            cache.set('a', 'x' * 400)
+            cache.set('b', 'x' * 400)
+            time.sleep(0.01)
+            self.assertEqual(cache.get('a'), 'x' * 400)
+            time.sleep(0.01)
+            cache.set('c', 'x' * 400)
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(cache.get('a'), 'x' * 400)
+            cache.set('d', {'n': 1}, ttl=-1)
+            self.assertIsNone(cache.get('d'))
+            cache.delete('a')
+            self.assertIsNone(cache.get('a'))
+
+#Local backend that counts the calls it gets
+class CountingTranslator(LocalTranslator):
+    def __init__(self):
+        self.calls = []
+
+    def translate(self, texts, source_language, dest_language):
+        self.calls.append(list(texts))
+        return super(CountingTranslator, self).translate(texts, source_language, dest_language)
+
+class TranslateCase(RouteTestCase):
+    #A post is translated once, later requests come from the cache
+    def test_translate_endpoint(self):
+        backend = CountingTranslator()
+        self.addCleanup(setattr, translator, 'backend', translator.backend)
+        translator.backend = backend
+        translator.cache.clear()
+        u = User(username='user1', email='user1@example.com')
+        post = Post(body='hola', author=u, language='es')
+        db.session.add(post)
+        db.session.commit()
+        self.login(u)
+        self.assertIn(b'translate(1', self.client.get('/explore').data)
+        for i in range(3):
+            response = self.client.post('/translate', data={'post_id': post.id, 'dest_language': 'en'})
+            self.assertEqual(response.get_json(), {'text': '[es>en] hola'})
+        self.assertEqual(backend.calls, [['hola']])
+        self.assertEqual(self.client.post('/translate', data={'post_id': 99}).status_code, 404)
+
+    #Requests made while the batch window is open go out as one call per language pair,
+    #duplicates share a result
+    def test_batching(self):
+        backend = CountingTranslator()
+        service = Translator(backend, MemoryCache(1024 * 1024), window=0.2)
+        requests = [('hola', 'es', 'en'), ('adios', 'es', 'en'), ('hola', 'es', 'en'), ('salut', 'fr', 'en')]
+        results = [None] * len(requests)
+        def run(i):
+            results[i] = service.translate(*requests[i])
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['[es>en] hola', '[es>en] adios', '[es>en] hola', '[fr>en] salut'])
+        self.assertEqual(sorted(sorted(call) for call in backend.calls), [['adios', 'hola'], ['salut']])
+
+    #A backend that returns too few results fails the whole batch, nothing is left
+    #waiting and the next request is tried again
+    def test_short_batch(self):
+        backend = CountingTranslator()
+        service = Translator(backend, MemoryCache(1024 * 1024), window=0.2, timeout=5)
+        real = backend.translate
+        backend.translate = lambda texts, *args: real(texts, *args)[1:]
+        results = [None] * 2
+        def run(i):
+            try:
+                results[i] = service.translate(['hola', 'adios'][i], 'es', 'en')
+            except TranslationError as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(result, TranslationError) for result in results))
+        self.assertEqual(service.in_flight, {})
+        backend.translate = real
+        self.assertEqual(service.translate('hola', 'es', 'en'), '[es>en] hola')
+
+class SearchCase(RouteTestCase):
+    def fill(self):
+        now = datetime.utcnow()
+        u1 = User(username='john', email='john@example.com', about_me='likes python')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        posts = [Post(body='python python tips', author=u1, timestamp=now - timedelta(days=1)),
+                 Post(body='python python tips', author=u2, timestamp=now - timedelta(days=300)),
+                 Post(body='a long post that mentions python once among other words', author=u2, timestamp=now),
+                 Post(body='nothing to see here', author=u1, timestamp=now)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return u1, u2, posts
+
+    #Ranked by relevance and recency, paged with cursors, kept up to date on commit
+    def check_index(self):
+        u1, u2, posts = self.fill()
+        results, cursor = search.search_posts('python', per_page=2)
+        self.assertEqual(results, [posts[0], posts[2]])
+        results, cursor = search.search_posts('python', cursor, per_page=2)
+        self.assertEqual((results, cursor), ([posts[1]], None))
+        self.assertEqual(search.search_posts('pyth')[0], [posts[0], posts[2], posts[1]])
+        self.assertEqual(search.search_posts('python words')[0], [posts[2]])
+        self.assertEqual(search.search_users('pyth'), [u1])
+        posts[3].body = 'python after all'
+        db.session.delete(posts[2])
+        db.session.commit()
+        self.assertEqual(set(search.search_posts('python')[0]), {posts[0], posts[1], posts[3]})
+        self.assertEqual(search.search_posts('words')[0], [])
+        db.session.add(Post(body='rolled back python', author=u1))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(search.search_posts('rolled')[0], [])
+        search.get_index().rebuild()
+        self.assertEqual(len(search.search_posts('python')[0]), 3)
+
+    def test_fts_index(self):
+        self.assertIsInstance(search.get_index(), search.FTSIndex)
+        self.check_index()
+
+    def test_python_index(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(setattr, search, 'search_index', search.search_index)
+        search.search_index = search.PythonIndex(os.path.join(directory.name, 'search.db'))
+        self.check_index()
+
+    def test_search_page(self):
+        u1, u2, posts = self.fill()
+        self.login(u2)
+        response = self.client.get('/search?q=python')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'likes python', response.data)
+        self.assertIn('id="post{}"'.format(posts[0].id).encode(), response.data)
+        self.assertNotIn(b'Following', response.data)
+        self.assertEqual(self.client.get('/search').status_code, 302)
+
+    #Follow state of every listed user comes from the followed id memo
+    def test_search_page_following(self):
+        u1, u2, posts = self.fill()
+        others = [User(username='fan{}'.format(i), email='fan{}@example.com'.format(i), about_me='python fan')
+                  for i in range(4)]
+        db.session.add_all(others)
+        db.session.commit()
+        for user in others[:3]:
+            u2.follow(user)
+        db.session.commit()
+        self.login(u2)
+        with QueryCounter() as queries:
+            response = self.client.get('/search?q=python')
+        self.assertEqual(response.data.count(b'Following'), 3)
+        self.assertIn(b'fan3', response.data)
+        self.assertEqual(sum('FROM followers' in statement for statement in queries.statements), 1)
+
+#The migrations build the same schema as the models, so "flask db migrate" has
+#nothing to generate, the FTS5 tables included
+class MigrationCase(unittest.TestCase):
+    DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        flask_migrate.downgrade(self.DIRECTORY, 'base')
+        db.session.execute(db.text('DROP TABLE IF EXISTS alembic_version'))
+        db.session.commit()
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_no_autogenerate_diffs(self):
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest('FTS5 tables are SQLite only')
+        flask_migrate.upgrade(self.DIRECTORY)
+        tables = sqlalchemy.inspect(db.engine).get_table_names()
+        self.assertIn('post_fts_data', tables)
+        with db.engine.connect() as conn:
+            context = MigrationContext.configure(conn, opts={'include_object': search.include_in_migrations})
+            self.assertEqual(compare_metadata(context, db.metadata), [])
+
+class BenchCase(RouteTestCase):
+    #Seeded data is consistent (counters, no self follows) and every route answers under load
+    def test_seed_and_run(self):
+        result = app.test_cli_runner().invoke(args=['bench', 'seed', '--users', '30', '--posts', '200',
+                                                    '--follows', '4', '--seed', '1'])
+        self.assertIn('30 user(s)', result.output)
+        self.assertEqual(Post.query.count(), 200)
+        self.assertEqual(db.session.scalar(db.select(db.func.count()).where(
+            followers.c.follower_id == followers.c.followed_id)), 0)
+        self.assertEqual(User.repair_counts(), 0)
+        self.assertTrue(search.search_posts(bench.WORDS[0])[0])
+        #The in-memory test database is one shared connection, so a single client here
+        report = bench.run(duration=5, clients=1, requests=6, seed=1)
+        self.assertEqual(report['all']['requests'], 6)
+        self.assertEqual(report['all']['errors'], 0)
+        for endpoint in bench.ENDPOINTS[:3]:
+            self.assertGreater(report[endpoint]['requests'], 0)
+            self.assertLessEqual(report[endpoint]['p50'], report[endpoint]['p99'])
+
+class ProfilingCase(RouteTestCase):
+    def test_request_profiling(self):
+        if request_profiler.installed:
+            self.addCleanup(request_profiler.install)
+        request_profiler.install()
+        request_profiler.reset()
+        self.addCleanup(request_profiler.reset)
+        self.addCleanup(request_profiler.uninstall)
+        self.addCleanup(setattr, request_profiler, 'slow_ms', request_profiler.slow_ms)
+        request_profiler.slow_ms = 0
+        u = User(username='susan', email='susan@example.com')
+        db.session.add(Post(body='my post', author=u))
+        db.session.commit()
+        self.login(u)
+        with QueryCounter() as queries, self.assertLogs(app.logger, 'INFO') as logs:
+            response = self.client.get('/index')
+        timing = response.headers['Server-Timing']
+        self.assertIn('desc="{} queries"'.format(queries.count), timing)
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('endpoint=index', logs.output[0])
+        self.assertTrue(any('Slow request /index' in line for line in logs.output))
+
+        metrics = self.client.get('/_metrics').data.decode()
+        self.assertIn('microblog_requests_total{endpoint="index"} 1', metrics)
+        self.assertIn('microblog_db_queries_total{{endpoint="index"}} {}'.format(queries.count), metrics)
+        self.assertIn('microblog_request_duration_seconds_bucket{endpoint="index",le="+Inf"} 1', metrics)
+        self.assertEqual(metrics.count('microblog_slowest_query_seconds{endpoint="index"'),
+                         min(request_profiler.top, queries.count))
+        request_profiler.uninstall()
+        self.assertEqual(self.client.get('/_metrics').status_code, 404)
+
+    #Localhost only without a token, the token when there is one
+    def test_metrics_access(self):
+        if not request_profiler.installed:
+            request_profiler.install()
+            self.addCleanup(request_profiler.uninstall)
+        remote = {'REMOTE_ADDR': '10.0.0.1'}
+        self.assertEqual(self.client.get('/_metrics').status_code, 200)
+        self.assertEqual(self.client.get('/_metrics', environ_base=remote).status_code, 403)
+        self.addCleanup(app.config.__setitem__, 'PROFILING_METRICS_TOKEN', app.config['PROFILING_METRICS_TOKEN'])
+        app.config['PROFILING_METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/_metrics').status_code, 403)
+        self.assertEqual(self.client.get('/_metrics', environ_base=remote, headers={
+            'Authorization': 'Bearer secret'}).status_code, 200)
+
+    #A failing statement doesn't leave its start time behind
+    def test_failed_statement(self):
+        if not request_profiler.installed:
+            request_profiler.install()
+            self.addCleanup(request_profiler.uninstall)
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute(db.text('SELECT * FROM no_such_table'))
+            self.assertEqual(conn.info['profile_start'], [])
+
+class ApiCase(RouteTestCase):
+    def fill(self):
+        now = datetime.utcnow()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        posts = [Post(body='post {}'.format(i), author=[u1, u2, u3][i % 3], timestamp=now - timedelta(minutes=10 - i))
+                 for i in range(9)]
+        db.session.add_all(posts)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        return u1, u2, u3, posts
+
+    #Pages through the feeds, polls with the validators get a 304 without the feed query
+    def test_feeds(self):
+        u1, u2, u3, posts = self.fill()
+        self.login(u1)
+        response = self.client.get('/api/timeline?limit=4')
+        data = response.get_json()
+        self.assertEqual([post['id'] for post in data['posts']], [posts[7].id, posts[6].id, posts[4].id, posts[3].id])
+        self.assertEqual(data['posts'][0], {'id': posts[7].id, 'body': 'post 7', 'author': 'susan', 'language': None,
+                                            'timestamp': posts[7].timestamp.isoformat() + 'Z'})
+        data = self.client.get(data['next']).get_json()
+        self.assertEqual([post['id'] for post in data['posts']], [posts[1].id, posts[0].id])
+        self.assertIsNone(data['next'])
+        self.assertEqual(len(self.client.get('/api/explore').get_json()['posts']), 9)
+        self.assertEqual(len(self.client.get('/api/users/mary/posts').get_json()['posts']), 3)
+        self.assertEqual(self.client.get('/api/users/nobody/posts').status_code, 404)
+
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.last_modified)
+        with QueryCounter() as queries:
+            cached = self.client.get('/api/timeline?limit=4', headers={'If-None-Match': etag})
+        self.assertEqual(cached.status_code, 304)
+        #User and newest post lookups only
+        self.assertLessEqual(queries.count, 2)
+        cached = self.client.get('/api/timeline?limit=4', headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(cached.status_code, 304)
+
+        #A new post from someone followed changes the validators, since= returns just that one
+        post = Post(body='new post', author=u2)
+        db.session.add(post)
+        post.fan_out()
+        db.session.commit()
+        response = self.client.get('/api/timeline?limit=4', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        data = self.client.get('/api/timeline?since=' + posts[8].timestamp.isoformat() + 'Z').get_json()
+        self.assertEqual([post['body'] for post in data['posts']], ['new post'])
+
+    #Following, unfollowing and profile edits change the validators without a new post
+    def test_feed_changes_without_posts(self):
+        u1, u2, u3, posts = self.fill()
+        self.login(u1)
+        def modified(url, response):
+            return self.client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 200
+        #anna's only post is older than the newest one on the timeline
+        u4 = User(username='anna', email='anna@example.com')
+        db.session.add(Post(body='old post', author=u4, timestamp=datetime.utcnow() - timedelta(days=1)))
+        db.session.commit()
+        response = self.client.get('/api/timeline')
+        u1.follow(u4)
+        db.session.commit()
+        self.assertTrue(modified('/api/timeline', response))
+        response = self.client.get('/api/timeline')
+        u1.unfollow(u4)
+        db.session.commit()
+        self.assertTrue(modified('/api/timeline', response))
+        response = self.client.get('/api/timeline')
+        self.assertFalse(modified('/api/timeline', response))
+        user_posts = self.client.get('/api/users/susan/posts')
+        u2.last_changed = datetime.utcnow() + timedelta(seconds=1)
+        db.session.commit()
+        self.assertTrue(modified('/api/timeline', response))
+        self.assertTrue(modified('/api/users/susan/posts', user_posts))
+        response = self.client.get('/api/timeline')
+        self.assertEqual(response.last_modified.replace(tzinfo=None), u2.last_changed.replace(microsecond=0))
+
+    def test_login_required(self):
+        self.assertEqual(self.client.get('/api/explore').status_code, 401)
+
+class PasswordCase(RouteTestCase):
+    def setUp(self):
+        super(PasswordCase, self).setUp()
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', app.config.get('WTF_CSRF_ENABLED', True))
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(setattr, password_hasher, 'method', password_hasher.method)
+        self.addCleanup(setattr, login_limiter, 'per_user', login_limiter.per_user)
+        self.addCleanup(setattr, login_limiter, 'per_ip', login_limiter.per_ip)
+        login_limiter.per_user, login_limiter.per_ip = MemoryLimiter(2, 60), MemoryLimiter(10, 60)
+
+    def post_login(self, password):
+        return self.client.post('/login', data={'username': 'susan', 'password': password})
+
+    #Hashes made under old parameters are replaced on the next good login
+    def test_rehash_on_login(self):
+        password_hasher.method = 'pbkdf2:sha256:1000'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        old_hash = u.password_hash
+        password_hasher.method = 'pbkdf2:sha256:2000'
+        self.assertTrue(password_hasher.needs_rehash(old_hash))
+        self.assertEqual(self.post_login('cat').status_code, 302)
+        db.session.expire_all()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertFalse(password_hasher.needs_rehash(u.password_hash))
+        self.assertTrue(u.check_password('cat'))
+
+    #Past the limit even the right password is refused without being checked
+    def test_login_rate_limit(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        checks = []
+        check_password = User.check_password
+        self.addCleanup(setattr, User, 'check_password', check_password)
+        User.check_password = lambda user, password: checks.append(password) or check_password(user, password)
+        for i in range(2):
+            self.assertEqual(self.post_login('dog').status_code, 302)
+        self.assertEqual(self.post_login('cat').status_code, 429)
+        self.assertEqual(checks, ['dog', 'dog'])
+
+    def test_limiter_window(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for limiter in [MemoryLimiter(2, 10), SQLiteLimiter(os.path.join(directory.name, 'logins.db'), 2, 10)]:
+            now = [1000.0]
+            limiter.clock = lambda: now[0]
+            limiter.hit('user:susan')
+            now[0] += 5
+            limiter.hit('user:susan')
+            self.assertFalse(limiter.allow('user:susan'))
+            self.assertTrue(limiter.allow('user:john'))
+            now[0] += 5.5
+            self.assertTrue(limiter.allow('user:susan'))
+            limiter.hit('user:susan')
+            self.assertFalse(limiter.allow('user:susan'))
+            limiter.reset('user:susan')
+            self.assertTrue(limiter.allow('user:susan'))
+
+    def test_hashing_busy(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, queue=0)
+        self.assertTrue(hasher.verify(hasher.hash('cat'), 'cat'))
+        hasher.slots.acquire()
+        self.assertRaises(HashingBusy, hasher.hash, 'cat')
+
+class UserCacheCase(RouteTestCase):
+    def setUp(self):
+        super(UserCacheCase, self).setUp()
+        self.addCleanup(setattr, user_cache, 'cache', user_cache.cache)
+        user_cache.cache = MemoryCache(1024 * 1024)
+
+    #Requests after the first load the user without a query, writes to the user drop the row
+    def test_user_loader_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        id, other = u1.id, u2.id
+        self.assertIs(user_cache.get(db.session, id), u1)
+        self.assertIsNotNone(user_cache.cache.get(user_cache.key(id)))
+
+        db.session.remove()
+        with QueryCounter() as queries:
+            user = user_cache.get(db.session, id)
+            self.assertEqual((user.username, user.followers_count), ('john', 0))
+        self.assertEqual(queries.count, 0)
+        self.assertTrue(user.check_password('cat'))
+
+        for change in [lambda: setattr(user, 'about_me', 'hi'),
+                       lambda: user.follow(db.session.get(User, other)),
+                       lambda: db.session.add(Post(body='post', author=user))]:
+            user_cache.get(db.session, id)
+            self.assertIsNotNone(user_cache.cache.get(user_cache.key(id)))
+            change()
+            db.session.flush()
+            self.assertIsNone(user_cache.cache.get(user_cache.key(id)))
+            db.session.commit()
+        db.session.remove()
+        user = user_cache.get(db.session, id)
+        self.assertEqual((user.about_me, user.followed_count, user.posts_count), ('hi', 1, 1))
+
+        #The last_seen writer drops the rows it updates
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        queue = JobQueue(os.path.join(directory.name, 'jobs.db'), external=True)
+        tracker = LastSeenTracker(queue)
+        tracker.touch(user, datetime.utcnow() + timedelta(hours=1))
+        tracker.flush()
+        queue.drain()
+        self.assertIsNone(user_cache.cache.get(user_cache.key(id)))
+
+    #A page for a logged in user costs no user query
+    def test_login_request(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        user_cache.set(u)
+        db.session.remove()
+        with QueryCounter() as queries:
+            self.assertEqual(self.client.get('/api/explore').status_code, 200)
+        self.assertFalse(any('FROM user' in statement for statement in queries.statements))
+
+class UniquenessCase(RouteTestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('user{}'.format(i))
+        self.assertTrue(all('user{}'.format(i) in bloom for i in range(1000)))
+        false_positives = sum('other{}'.format(i) in bloom for i in range(1000))
+        self.assertLess(false_positives, 30)
+
+    #Until the filters are built every check goes to the index. Then free names
+    #cost no query, possible hits are checked in the database, committed users go into the filter
+    def test_checker(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        checker = UniquenessChecker(capacity=1000, rebuild_interval=0)
+        with QueryCounter() as queries:
+            self.assertFalse(checker.taken('username', 'susan'))
+        self.assertEqual(queries.count, 1)
+        self.assertIsNone(checker.filters)
+        checker.build()
+        self.assertTrue(checker.taken('username', 'john'))
+        self.assertTrue(checker.taken('email', 'john@example.com'))
+        with QueryCounter() as queries:
+            self.assertFalse(checker.taken('username', 'susan'))
+            self.assertFalse(checker.taken('email', 'john'))
+        self.assertEqual(queries.count, 0)
+        self.addCleanup(setattr, uniqueness, 'filters', uniqueness.filters)
+        uniqueness.filters = checker.filters
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.assertIn('susan', checker.filters['username'])
+        self.assertTrue(checker.taken('username', 'susan'))
+
+    #The first check starts the thread, which builds the filters right away and
+    #again once they fill up
+    def test_background_builds(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        checker = UniquenessChecker(capacity=1, rebuild_interval=60)
+        self.assertTrue(checker.taken('username', 'john'))
+        deadline = time.monotonic() + 5
+        while checker.filters is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        first = checker.filters
+        self.assertIn('john', first['username'])
+        checker.add('username', 'susan')
+        checker.add('username', 'mary')
+        self.assertFalse(checker.taken('username', 'mary'))
+        while checker.filters is first and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNot(checker.filters, first)
+
+    def test_registration(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', app.config.get('WTF_CSRF_ENABLED', True))
+        app.config['WTF_CSRF_ENABLED'] = False
+        data = {'username': 'susan', 'email': 'john@example.com', 'password': 'cat', 'password2': 'cat'}
+        with app.test_request_context(method='POST', data=data):
+            form = RegistrationForm()
+            self.assertFalse(form.validate())
+            self.assertIn('Email already in use', [str(error) for error in form.email.errors])
+
+        #A filter that missed a user still can't produce a duplicate
+        self.addCleanup(setattr, uniqueness, 'filters', uniqueness.filters)
+        uniqueness.filters = {field: BloomFilter(1000) for field in UniquenessChecker.FIELDS}
+        response = self.client.post('/register', data=dict(data, username='john', email='john2@example.com'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Username taken', response.data)
+        self.assertEqual(User.query.count(), 1)
+
+class ExploreCacheCase(RouteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, explore_cache, 'snapshot', None)
+        self.addCleanup(setattr, explore_cache, 'pages', explore_cache.pages)
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {:02d}'.format(i), author=u, timestamp=now - timedelta(minutes=i))
+                            for i in range(25)])
+        db.session.commit()
+        self.login(u)
+
+    #Follows the Older posts links from /explore, returns the bodies on each page
+    #and the link back from the last one
+    def walk(self):
+        pages, url = [], '/explore'
+        while True:
+            data = self.client.get(url).data
+            pages.append(re.findall(rb'<span id="post\d+">([^<]*)</span>', data))
+            prev_url = re.search(rb'class="previous[^"]*">\s*<a href="([^"]+)"', data).group(1)
+            url = re.search(rb'class="next[^"]*">\s*<a href="([^"]+)"', data).group(1)
+            if url == b'#':
+                return pages, prev_url.decode()
+            url = url.decode()
+
+    #Pages inside the snapshot come from memory, the rest from the database, same as without the cache
+    def test_snapshot_pages(self):
+        expected, back = self.walk()
+        self.assertEqual([len(page) for page in expected], [10, 10, 5])
+        explore_cache.pages = 2
+        explore_cache.refresh()
+        with QueryCounter() as queries:
+            self.assertEqual(re.findall(rb'<span id="post\d+">([^<]*)</span>', self.client.get('/explore').data),
+                             expected[0])
+        self.assertFalse([statement for statement in queries.statements if 'FROM post' in statement])
+        self.assertEqual(self.walk(), (expected, back))
+        #A newer-posts cursor is found in the snapshot too
+        data = self.client.get(back).data
+        self.assertEqual(re.findall(rb'<span id="post\d+">([^<]*)</span>', data), expected[1])
+
+    #Without the background thread a new post drops the snapshot
+    def test_invalidate_on_post(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+        explore_cache.refresh()
+        self.client.post('/index', data={'post': 'brand new'})
+        self.assertIsNone(explore_cache.snapshot)
+        self.assertIn(b'brand new', self.client.get('/explore').data)
+
+    #Requests get the old snapshot while the thread builds the new one
+    def test_stale_while_revalidate(self):
+        cache = ExploreCache(pages=1, interval=60)
+        old = cache.refresh()
+        #Thread not running yet, so invalidate() keeps the snapshot as it would with one
+        cache.thread = threading.Thread(target=cache.run, daemon=True)
+        cache.invalidate()
+        self.assertIs(cache.get(), old)
+        cache.thread.start()
+        deadline = time.monotonic() + 5
+        while cache.get() is old and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNot(cache.get(), old)
+        self.assertEqual(cache.get().keys, old.keys)
+        self.assertFalse(cache.get().complete)
+
+    #Invalidations within min_interval of the last refresh are merged into one
+    def test_refresh_rate(self):
+        cache = ExploreCache(pages=1, interval=60, min_interval=0.3)
+        refreshes = []
+        refresh = cache.refresh
+        def counting_refresh():
+            refreshes.append(time.monotonic())
+            return refresh()
+        cache.refresh = counting_refresh
+        cache.start()
+        deadline = time.monotonic() + 5
+        while cache.get() is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for i in range(5):
+            cache.invalidate()
+            time.sleep(0.02)
+        while len(refreshes) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.4)
+        self.assertEqual(len(refreshes), 2)
+        self.assertGreaterEqual(refreshes[1] - refreshes[0], 0.3)
+
+class FollowImportCase(RouteTestCase):
+    def users(self, count):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(count)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body='post from {}'.format(u.username), author=u) for u in users])
+        db.session.commit()
+        return users
+
+    #Existing edges, unknown names and self are skipped, counters and timelines follow
+    def test_follow_many(self):
+        users = self.users(40)
+        me = users[0]
+        me.follow(users[1])
+        db.session.commit()
+        self.assertEqual(me.followed_count, 1)
+        with QueryCounter() as few:
+            new = me.follow_many(['user1', 'user2', 'user3', 'nobody', 'user0'])
+        db.session.commit()
+        self.assertEqual(new, [users[2].id, users[3].id])
+        self.assertEqual((me.followed_count, users[2].followers_count, users[1].followers_count), (3, 1, 1))
+        self.assertEqual(sorted(u.id for u in me.followed), [u.id for u in users[1:4]])
+        #The number of statements doesn't depend on how many names there are
+        names = [u.username for u in users]
+        self.assertEqual(users[1].followed_count, 0)
+        with QueryCounter() as many:
+            users[1].follow_many(names)
+        db.session.commit()
+        self.assertEqual(few.count, many.count)
+        self.assertEqual(User.repair_counts(), 0)
+        if app.config['TIMELINE_FANOUT']:
+            self.assertEqual(me.timeline_drift(), (set(), set()))
+
+    #Databases without ON CONFLICT skip the existing edges up front
+    def test_follow_many_without_on_conflict(self):
+        self.addCleanup(setattr, models, 'ON_CONFLICT_INSERTS', models.ON_CONFLICT_INSERTS)
+        models.ON_CONFLICT_INSERTS = {}
+        users = self.users(4)
+        users[0].follow(users[1])
+        db.session.commit()
+        self.assertEqual(users[0].follow_many(['user1', 'user2']), [users[2].id])
+        db.session.commit()
+        self.assertEqual((users[0].followed_count, users[1].followers_count), (2, 1))
+        self.assertEqual(User.repair_counts(), 0)
+
+    #Exports stream in both formats and can be fed back into /api/follow
+    def test_export_and_import(self):
+        users = self.users(4)
+        users[0].follow_many(['user1', 'user2'])
+        users[3].follow(users[0])
+        db.session.commit()
+        self.login(users[0])
+        response = self.client.get('/user/user0/following.csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        following = response.get_data(as_text=True)
+        self.assertEqual(following.splitlines(), ['username', 'user1', 'user2'])
+        response = self.client.get('/user/user0/followers.jsonl')
+        self.assertEqual(response.get_data(as_text=True), '{"username": "user3"}\n')
+        self.assertEqual(self.client.get('/user/user1/followers.csv').status_code, 403)
+
+        response = self.client.post('/api/follow', data=following + 'user3\n', content_type='text/csv')
+        self.assertEqual(response.get_json(), {'followed': 1, 'skipped': 2})
+        response = self.client.post('/api/follow', json={'usernames': ['user1', 'user0']})
+        self.assertEqual(response.get_json(), {'followed': 0, 'skipped': 2})
+        self.assertEqual(self.client.post('/api/follow', data={'usernames': 'user1'}).status_code, 415)
+        self.assertEqual(self.client.post('/api/follow', json={'usernames': 'user1'}).status_code, 400)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, users[0].id).followed_count, 3)
+
+class PostExportCase(RouteTestCase):
+    #Posts stream out in chunks, as JSONL, CSV or gzipped, from the route and the CLI
+    def test_export_posts(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        start = datetime.utcnow() - timedelta(days=1)
+        db.session.execute(Post.__table__.insert(), [
+            {'body': 'post {}'.format(i), 'user_id': u.id, 'timestamp': start + timedelta(seconds=i)}
+            for i in range(2500)])
+        db.session.commit()
+        self.login(u)
+
+        response = self.client.get('/user/john/export', buffered=False)
+        self.assertTrue(response.is_streamed)
+        chunks = list(response.response)
+        self.assertEqual(len(chunks), 3)
+        jsonl = b''.join(chunks)
+        lines = jsonl.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2500)
+        self.assertEqual(json.loads(lines[0]), {'id': 1, 'timestamp': start.isoformat() + 'Z',
+                                                'body': 'post 0', 'language': None})
+        self.assertIn('post 2499', lines[-1])
+
+        response = self.client.get('/user/john/export?gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertIn('john-posts.jsonl.gz', response.headers['Content-Disposition'])
+        self.assertEqual(gzip.decompress(response.data), jsonl)
+        csv_lines = self.client.get('/user/john/export?format=csv').get_data(as_text=True).splitlines()
+        self.assertEqual((csv_lines[0], len(csv_lines)), ('id,timestamp,body,language', 2501))
+        self.assertEqual(self.client.get('/user/john/export?format=xml').status_code, 400)
+
+        result = app.test_cli_runner().invoke(args=['export', 'posts', 'john'])
+        self.assertEqual(result.output.encode('utf-8'), jsonl)
+
+class ResponseLayerCase(RouteTestCase):
+    #Large text responses are gzipped for clients that take it and get a weak ETag
+    def test_compression_and_etags(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body='post {}'.format(i), author=u) for i in range(10)])
+        db.session.commit()
+        self.login(u)
+        plain = self.client.get('/explore')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        compressed = self.client.get('/explore', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
+        self.assertLess(len(compressed.data), len(plain.data))
+
+        etag = plain.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(compressed.headers['ETag'], etag)
+        self.assertEqual(self.client.get('/explore', headers={'If-None-Match': etag}).status_code, 304)
+        #Small responses go out as they are, the API keeps its own ETag
+        small = self.client.get('/api/users/nobody/posts', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', small.headers)
+        api = self.client.get('/api/explore', headers={'Accept-Encoding': 'gzip'})
+        self.assertFalse(api.headers['ETag'].startswith('W/'))
+
+    #Logged out pages are rendered once per locale, each response gets its own CSRF token
+    def test_anonymous_page_cache(self):
+        responses.page_cache = MemoryCache(1024 * 1024)
+        self.addCleanup(setattr, responses, 'page_cache', None)
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        rendered = []
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, app)
+        self.addCleanup(template_rendered.disconnect, record, app)
+
+        first = self.client.get('/login').get_data(as_text=True)
+        self.assertIn('login.html', rendered)
+        del rendered[:]
+        other = app.test_client()
+        second = other.get('/login').get_data(as_text=True)
+        self.assertEqual(rendered, [])
+        self.assertNotIn(responses.CSRF_SENTINEL, first + second)
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', second).group(1)
+        self.assertEqual(re.sub(r'value="[^"]+"', '', first), re.sub(r'value="[^"]+"', '', second))
+        self.assertNotEqual(self.client.get('/register').data, second.encode('utf-8'))
+        self.assertIn('register.html', rendered)
+
+        #A page with a flashed message is rendered and not stored
+        del rendered[:]
+        anonymous = app.test_client()
+        anonymous.get('/index')
+        self.assertIn('Please log in', anonymous.get('/login').get_data(as_text=True))
+        self.assertIn('login.html', rendered)
+        self.assertNotIn('Please log in', app.test_client().get('/login').get_data(as_text=True))
+
+        #The token served from the cache is good for logging in (last, g keeps the logged in user)
+        response = other.post('/login', data={'username': 'john', 'password': 'cat', 'csrf_token': token})
+        self.assertEqual(response.status_code, 302)
+
+class ReadReplicaCase(RouteTestCase):
+    #Explore and feed reads go to the 'read' engine when there is one
+    def test_replica_routing(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(directory.name, 'replica.db'))
+        self.addCleanup(engine.dispose)
+        db.metadata.create_all(engine, tables=[User.__table__, Post.__table__, followers])
+        with engine.begin() as conn:
+            conn.execute(User.__table__.insert(), {'id': 1, 'username': 'john', 'email': 'john@example.com'})
+            conn.execute(Post.__table__.insert(), {'body': 'from the replica', 'user_id': 1,
+                                                   'timestamp': datetime.utcnow()})
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='from the primary', author=u)])
+        db.session.commit()
+        self.login(u)
+        self.assertIn(b'from the primary', self.client.get('/explore').data)
+        db.engines['read'] = engine
+        self.addCleanup(db.engines.pop, 'read')
+        self.assertIn(b'from the replica', self.client.get('/explore').data)
+        self.assertIn(b'from the replica', self.client.get('/index').data)
+        #Writes and everything else stay on the primary
+        self.assertEqual(Post.query.one().body, 'from the primary')
+
+#Concurrent writers and readers against a SQLite file with the default settings
+#(before) and with the pragmas from app/database.py (after),
+#run with python tests.py -v to see the report
+class SQLiteTuningBenchmark(unittest.TestCase):
+    WRITERS = 4
+    READERS = 4
+    WRITES = 50
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def engine(self, name, tuned):
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(self.directory.name, name),
+                                          connect_args={'timeout': 1})
+        if tuned:
+            tune_sqlite(engine, sqlite_pragmas(app.config))
+        db.metadata.create_all(engine, tables=[User.__table__, Post.__table__])
+        with engine.begin() as conn:
+            conn.execute(User.__table__.insert(), {'id': 1, 'username': 'john', 'email': 'john@example.com'})
+        return engine
+
+    def run_load(self, engine):
+        errors, reads, done = [], [0], threading.Event()
+        insert = Post.__table__.insert()
+        latest = db.select(Post.__table__.c.id).order_by(Post.__table__.c.timestamp.desc()).limit(10)
+        def write():
+            for i in range(self.WRITES):
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(insert, {'body': 'post', 'user_id': 1, 'timestamp': datetime.utcnow()})
+                except sqlalchemy.exc.OperationalError as e:
+                    errors.append(e)
+        def read():
+            while not done.is_set():
+                try:
+                    with engine.connect() as conn:
+                        conn.execute(latest).all()
+                    reads[0] += 1
+                except sqlalchemy.exc.OperationalError as e:
+                    errors.append(e)
+        readers = [threading.Thread(target=read) for i in range(self.READERS)]
+        writers = [threading.Thread(target=write) for i in range(self.WRITERS)]
+        start = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        for thread in readers:
+            thread.join()
+        engine.dispose()
+        return elapsed, reads[0], len(errors)
+
+    def test_concurrent_load(self):
+        report = []
+        for label, tuned in [('before', False), ('after', True)]:
+            engine = self.engine(label + '.db', tuned)
+            with engine.connect() as conn:
+                mode = conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+            elapsed, reads, errors = self.run_load(engine)
+            writes = self.WRITERS * self.WRITES
+            report.append('{:6} {:6} {:8.0f} writes/s {:8.0f} reads/s {:4d} locked'.format(
+                label, mode, writes / elapsed, reads / elapsed, errors))
+            if tuned:
+                self.assertEqual(mode, 'wal')
+                self.assertEqual(errors, 0)
+        print('\n' + '\n'.join(report))
+
+#Renders a 50 post explore page with the md5 computed on every avatar() call (before)
+#and with the stored digest (after), run with python tests.py -v to see the report
+class AvatarBenchmark(RouteTestCase):
+    RUNS = 20
+
+    def legacy_avatar(self, size):
+        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+
+    def test_render_50_posts(self):
+        app.config['POSTS_PER_PAGE'] = 50
+        self.addCleanup(app.config.__setitem__, 'POSTS_PER_PAGE', 10)
+        users = [User(username='user{}'.format(i), email='User{}@Example.com'.format(i)) for i in range(50)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body='post {}'.format(i), author=u) for i, u in enumerate(users)])
+        db.session.commit()
+        self.login(users[0])
+
+        def render(runs):
+            start = time.perf_counter()
+            for i in range(runs):
+                data = self.client.get('/explore').data
+            return data, (time.perf_counter() - start) / runs * 1000
+
+        def avatars(runs=2000):
+            start = time.perf_counter()
+            for i in range(runs):
+                for u in users:
+                    u.avatar(70)
+            return (time.perf_counter() - start) / runs * 1000
+
+        render(2)
+        current = User.avatar
+        User.avatar = AvatarBenchmark.legacy_avatar
+        try:
+            before, before_ms = render(self.RUNS)
+            before_avatars = avatars()
+        finally:
+            User.avatar = current
+        after, after_ms = render(self.RUNS)
+        after_avatars = avatars()
+        self.assertEqual(before, after)
+        print('\n50 post page   before {:.3f} ms  after {:.3f} ms'.format(before_ms, after_ms))
+        print('50 avatar(70)  before {:.3f} ms  after {:.3f} ms'.format(before_avatars, after_avatars))
+
+#Just enough of an SMTP server to accept mail, counts connections and keeps messages
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 go ahead')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append(data)
+                self.reply('250 queued')
+            elif command == b'RCPT' and b'refused' in line:
+                self.reply('550 no such user')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+#Records what it was called with, fails while fail is set
+job_calls = []
+
+@task('test_record')
+def record_job(value, fail=False):
+    if fail:
+        raise ValueError('failed on purpose')
+    job_calls.append(value)
+
+@task('test_batch', batch=2)
+def record_batch(values):
+    job_calls.append([value for value, in values])
+
+class JobQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('localhost', 0), SMTPStandIn)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        #Flask-Mail reads its settings once at startup
+        state = app.extensions['mail']
+        self.saved = state.server, state.port, state.suppress
+        state.server, state.port, state.suppress = 'localhost', self.server.server_address[1], False
+        self.dir = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(os.path.join(self.dir.name, 'jobs.db'), external=True, max_attempts=2, backoff=0)
+        del job_calls[:]
+
+    def tearDown(self):
+        state = app.extensions['mail']
+        state.server, state.port, state.suppress = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    #Higher priority first, then oldest first, batch tasks get several jobs per call
+    def test_priority_and_batches(self):
+        self.queue.enqueue('test_record', 'low')
+        self.queue.enqueue('test_batch', 'b1')
+        self.queue.enqueue('test_record', 'high', priority=5)
+        self.queue.enqueue('test_batch', 'b2')
+        self.queue.enqueue('test_batch', 'b3')
+        self.queue.enqueue('test_record', 'later', delay=60)
+        self.assertEqual(self.queue.drain(), 5)
+        self.assertEqual(job_calls, ['high', 'low', ['b1', 'b2'], ['b3']])
+        self.assertEqual([row[:3] for row in self.queue.stats()], [('test_batch', 3, 0), ('test_record', 2, 0)])
+        self.assertEqual(self.queue.depth(), [('test_record', 'queued', 1)])
+
+    #Failures are retried with backoff, then kept as dead jobs until retried by hand
+    def test_retry_and_dead_jobs(self):
+        self.queue.enqueue('test_record', 'x', True)
+        self.assertEqual(self.queue.drain(), 2)
+        dead = self.queue.dead_letters()
+        self.assertEqual([(row[1], row[3]) for row in dead], [('test_record', 2)])
+        self.assertIn('failed on purpose', dead[0][4])
+        self.assertEqual(self.queue.stats()[0][:3], ('test_record', 2, 2))
+        self.queue.connection().execute("UPDATE job SET args = '[\"x\"]'")
+        self.assertEqual(self.queue.retry_dead(), 1)
+        self.assertEqual(self.queue.drain(), 1)
+        self.assertEqual((job_calls, self.queue.dead_letters()), (['x'], []))
+
+    #Mail goes out from the worker, an unreachable server means another attempt later
+    def test_send_email(self):
+        with app.app_context():
+            app.extensions['mail'].port = 1
+            self.queue.enqueue('send_email', 'hello', 'admin@example.com', ['user@example.com'], 'body', None)
+            self.queue.backoff = 60
+            self.assertEqual(self.queue.drain(), 1)
+            self.assertEqual(self.queue.depth(), [('send_email', 'queued', 1)])
+            app.extensions['mail'].port = self.server.server_address[1]
+            self.queue.connection().execute('UPDATE job SET next_attempt = 0')
+            self.assertEqual(self.queue.drain(), 1)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn(b'hello', self.server.messages[0])
+
+    #Queued mail goes out in one batch over a single connection
+    def test_mail_batch_over_one_connection(self):
+        with app.app_context():
+            for i in range(7):
+                self.queue.enqueue('send_email', 'hello {}'.format(i), 'admin@example.com', ['user@example.com'],
+                                   'body', '<p>body</p>')
+            self.assertEqual(self.queue.drain(), 7)
+        self.assertEqual(len(self.server.messages), 7)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.queue.stats()[0][:3], ('send_email', 7, 0))
+
+    #A refused message is retried on its own, the rest of its batch isn't sent again
+    def test_mail_batch_partial_failure(self):
+        with app.app_context():
+            for recipient in ['a@example.com', 'refused@example.com', 'b@example.com']:
+                self.queue.enqueue('send_email', 'hello', 'admin@example.com', [recipient], 'body', None)
+            self.assertEqual(self.queue.drain(), 4)
+        self.assertEqual(len(self.server.messages), 2)
+        dead = self.queue.dead_letters()
+        self.assertEqual(len(dead), 1)
+        self.assertIn('refused@example.com', dead[0][2])
+
+    #Worker threads pick jobs up as soon as they are queued
+    def test_worker_threads(self):
+        queue = JobQueue(self.queue.path, workers=2, poll=0.05)
+        for i in range(5):
+            queue.enqueue('test_record', i)
+        deadline = time.monotonic() + 5
+        while len(job_calls) < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(job_calls), list(range(5)))
+
+#Query plans and timings for the follow graph queries on a seeded dataset,
+#"before" copies the tables without the followers primary key/reverse index and
+#the (user_id, timestamp) post index, "after" is the current schema
+#Run with python tests.py -v (or pytest -s) to see the report
+class FollowGraphBenchmark(unittest.TestCase):
+    USERS = 2000
+    EDGES = 40000
+    POSTS = 20000
+
+    QUERIES = {
+        'is_following': 'SELECT 1 FROM {followers} WHERE follower_id = :a AND followed_id = :b LIMIT 1',
+        'followers_count': 'SELECT count(*) FROM {followers} WHERE followed_id = :b',
+        'followed_posts': 'SELECT p.id FROM {post} p JOIN {followers} f ON f.followed_id = p.user_id '
+                          'WHERE f.follower_id = :a ORDER BY p.timestamp DESC LIMIT 10',
+        'user_posts': 'SELECT id FROM {post} WHERE user_id = :b ORDER BY timestamp DESC LIMIT 10',
+    }
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest('query plans are SQLite specific')
+        db.create_all()
+        rng = random.Random(0)
+        now = datetime.utcnow()
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)}
+            for i in range(1, self.USERS + 1)])
+        edges = set()
+        while len(edges) < self.EDGES:
+            a, b = rng.randint(1, self.USERS), rng.randint(1, self.USERS)
+            if a != b:
+                edges.add((a, b))
+        db.session.execute(followers.insert(), [
+            {'follower_id': a, 'followed_id': b} for a, b in edges])
+        db.session.execute(Post.__table__.insert(), [
+            {'body': 'post', 'user_id': rng.randint(1, self.USERS), 'timestamp': now - timedelta(seconds=i)}
+            for i in range(self.POSTS)])
+        db.session.execute(db.text('CREATE TABLE followers_before AS SELECT * FROM followers'))
+        db.session.execute(db.text('CREATE TABLE post_before AS SELECT * FROM post'))
+        db.session.execute(db.text('CREATE INDEX ix_post_before_timestamp ON post_before (timestamp)'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.execute(db.text('DROP TABLE IF EXISTS followers_before'))
+        db.session.execute(db.text('DROP TABLE IF EXISTS post_before'))
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def plan(self, sql):
+        rows = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql), {'a': 1, 'b': 2}).all()
+        return ' / '.join(row[-1] for row in rows)
+
+    def timing(self, sql, runs=50):
+        start = time.perf_counter()
+        for i in range(runs):
+            db.session.execute(db.text(sql), {'a': i + 1, 'b': i + 2}).all()
+        return (time.perf_counter() - start) / runs * 1000
+
+    def test_follow_graph_indexes(self):
+        tables = {'before': {'followers': 'followers_before', 'post': 'post_before'},
+                  'after': {'followers': 'followers', 'post': 'post'}}
+        report = []
+        for name, query in self.QUERIES.items():
+            for label, names in tables.items():
+                sql = query.format(**names)
+                plan = self.plan(sql)
+                report.append('{:16} {:6} {:8.3f} ms  {}'.format(name, label, self.timing(sql), plan))
+                if label == 'after':
+                    #No full scans of the follow graph once the indexes exist
+                    self.assertNotIn('SCAN f', plan)
+                    self.assertNotRegex(plan, r'SCAN (followers|post)\b')
+        print('\n' + '\n'.join(report))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)